@@ -27,39 +27,89 @@
 #   to determine why. If you have FreeCAD throwing obscure errors at you try
 #   changing the order of operations.
 
+import contextlib
+import gc
+import hashlib
 import json
 import logging
 import math
+import multiprocessing
+import resource
+import time
 
 import config
+import incremental
+import plate2d
+import startup
+import transforms
+import writers
+from cache import LayerCache
+from profiles import KEY_UNIT, PROFILES, rotate_points
+from workers import rss_mb
 
 log = logging.getLogger()
 
-import FreeCAD
-import cadquery
-import importDXF
-import importSVG
-import Mesh
-import Part
-
-
-# Constants
-KEY_UNIT = 19.05  # How many MM wide a 1u key is
-STABILIZERS = {
-    # size: (width_between_center, switch_offset)
-    2: (11.95, 0),
-    3: (19.05, 0),
-    4: (28.575, 0),
-    4.5: (34.671, 0),
-    5.5: (42.8625, 0),
-    6: (47.625, 9.525),
-    6.25: (50, 0),
-    6.5: (52.38, 0),
-    7: (57.15, 0),
-    8: (66.675, 0),
-    9: (66.675, 0),
-    10: (66.675, 0)
+# FreeCAD and cadquery are loaded with startup.load() when a layer needs them,
+# without them we can still draw DXF and SVG files with plate2d
+
+# Formats that need a 3D model, when none of these are requested plate2d is used instead of cadquery
+THREE_D_FORMATS = ('brp', 'js', 'mesh', 'stl', 'stp')
+
+MESH_TOLERANCE = 0.1  # How far (in mm) the web viewer's mesh can stray from the plate, the same as the TJS exporter
+
+# The layers in the order they are built, shape layers are drawn from the outline of the plate
+SHAPE_LAYERS = ('simple', 'bottom', 'closed', 'open')
+SWITCH_LAYERS = ('switch', 'reinforcing', 'top')
+
+# KeyboardCase attributes each shape layer is drawn from, the layer cache is keyed on these
+PLATE_SETTINGS = ('corner_type', 'corners', 'height', 'kerf', 'thickness', 'width')
+USB_SETTINGS = ('usb_height', 'usb_inner_width', 'usb_offset', 'usb_outer_width', 'y_pad', 'y_pcb_pad')
+LAYER_SETTINGS = {
+    'simple': PLATE_SETTINGS,
+    'bottom': PLATE_SETTINGS + ('foot_hole_diameter', 'foot_hole_square', 'foot_holes') + USB_SETTINGS,
+    'closed': PLATE_SETTINGS + ('foot_count', 'inside_height', 'inside_width'),
+    'open': PLATE_SETTINGS + ('foot_count', 'inside_height', 'inside_width') + USB_SETTINGS,
 }
+LAYER_CACHE_VERSION = 2  # Bump this when the way the shape layers are drawn or exported changes
+
+PROGRESS_INTERVAL = 0.5  # Seconds between progress reports while cutting the keys of a layer
+
+
+class Key(object):
+    """A single key from the layout.
+
+    x and y are the center of the key in mm from the top left corner of the
+    plate, w and h are in key units. The rest are the per key overrides from
+    the layout, None when the case default should be used.
+    """
+    __slots__ = ('x', 'y', 'w', 'h', 'switch_type', 'stab_type', 'kerf', 'rotate_key', 'rotate_stab', 'center_offset')
+
+    # Layout properties for each override
+    OVERRIDES = (('_t', 'switch_type'), ('_s', 'stab_type'), ('_k', 'kerf'), ('_r', 'rotate_key'), ('_rs', 'rotate_stab'), ('_co', 'center_offset'))
+
+    def __init__(self, x, y, properties):
+        self.x = x
+        self.y = y
+        self.w = properties.get('w', 1)
+        self.h = properties.get('h', 1)
+        for name, attribute in self.OVERRIDES:
+            setattr(self, attribute, properties.get(name))
+
+    def as_dict(self):
+        """Return the key as a dictionary using the layout's property names.
+        """
+        key = {'x': self.x, 'y': self.y, 'w': self.w, 'h': self.h}
+        for name, attribute in self.OVERRIDES:
+            if getattr(self, attribute) is not None:
+                key[name] = getattr(self, attribute)
+
+        return key
+
+    def fingerprint(self):
+        """Return a tuple of everything about the key that changes its cutouts.
+        """
+        return (self.x, self.y, self.w, self.h) + tuple(getattr(self, attribute) for name, attribute in self.OVERRIDES)
+
 
 class KeyboardCase(object):
     def __init__(self, keyboard_layout, export_basename, kerf=0.0,
@@ -71,8 +121,14 @@ class KeyboardCase(object):
                  thickness=1.5, holes=None, reinforcing=False, oversize=None,
                  oversize_distance=4, formats=None, foot_holes=None,
                  foot_count=None, foot_hole_diameter=3, foot_hole_square=9,
-                 usb_layers=None):
+                 usb_layers=None, batch_cuts=True, native_export=True,
+                 incremental=False, layer_cache=False, stl_deflection=0.1,
+                 stl_angle=30):
         # User settable things
+        self.batch_cuts = batch_cuts
+        self.native_export = native_export
+        self.stl_deflection = stl_deflection  # How far (in mm) the STL mesh can stray from the plate
+        self.stl_angle = stl_angle  # The most (in degrees) the STL mesh can turn between neighbouring triangles
         self.export_basename = export_basename
         self.case = {'type': case_type}
         self.corner_type = corner_type
@@ -101,16 +157,37 @@ class KeyboardCase(object):
         self.y_pcb_pad = pcb_height_padding / 2
 
         # Sanity checks
+        self.errors = []  # The kinds of problems we found, EG unknown_switch_type
+        if any(format in THREE_D_FORMATS for format in self.formats) and startup.load('cadquery') is None:
+            self.error('freecad_unavailable', 'FreeCAD is not available, only exporting 2D formats!')
+            self.formats = [format for format in self.formats if format not in THREE_D_FORMATS]
+
         if switch_type not in ('mx', 'alpsmx', 'mx-open', 'mx-open-rotatable', 'alps'):
-            log.error('Unknown switch type %s, defaulting to mx!', switch_type)
+            self.error('unknown_switch_type', 'Unknown switch type %s, defaulting to mx!', switch_type)
             self.switch_type = 'mx'
 
         if stab_type not in ('cherry', 'costar', 'cherry-costar', 'matias', 'alps'):
-            log.error('Unknown stabilizer type %s, defaulting to "cherry"!', stab_type)
+            self.error('unknown_stab_type', 'Unknown stabilizer type %s, defaulting to "cherry"!', stab_type)
             self.stab_type = 'cherry'
 
         # Plate state info
         self.UOM = "mm"
+        self.flat = not any(format in THREE_D_FORMATS for format in self.formats)  # Draw with plate2d instead of cadquery
+        if self.flat:
+            self.native_export = True
+        self.incremental = incremental and self.flat and self.batch_cuts  # Only batched plate2d plates can be patched
+        self.previous = None  # The snapshot of the last build like this one, see incremental.py
+        self.snapshot_key = None
+        self.plates = {}  # Finished layers, kept for the next snapshot
+        self.snapshot_cutouts = {}  # The labeled cutouts of each switch based layer, saved with the snapshot
+        self.keys_reused = {}  # How many keys each switch based layer reused from the previous build
+        self.layers_reused = []  # Layers that are the same as in the previous build
+        self.layer_cache = LayerCache(config.app['layer_cache_dir'], config.app['layer_cache_size']) if layer_cache else None
+        self.layers_cached = []  # Layers copied from the layer cache instead of being drawn
+        self.progress = None  # Called with each progress event during build(), see report()
+        self.document = None  # The FreeCAD document the layers are exported from, see open_document()
+        self.memory = {}  # RSS (in MB) at the start, peak and end of build(), see sample_memory()
+        self.cutouts = []
         self.exports = {}
         self.grow_y = 0
         self.grow_x = 0
@@ -118,10 +195,14 @@ class KeyboardCase(object):
         self.inside_height = 0
         self.inside_width = 0
         self.layers = ['switch']
-        self.layout = []
+        self.keys = []  # Every key in the layout
+        self.layout = []  # The keys, row by row
         self.origin = (0,0)
+        self.stages = {}  # Intermediate plates shared between layers, keyed on (stage, oversize)
+        self.stage_stats = {'computed': 0, 'reused': 0}
+        self.timings = {}  # Wall and CPU seconds spent in each stage of the build
+        self.boolean_ops = 0
         self.width = 0
-        self.x_off = 0
 
         # Initialize the case
         if self.case['type'] == 'poker':
@@ -132,13 +213,325 @@ class KeyboardCase(object):
             if mount_holes_num > 0 and mount_holes_size > 0:
                 self.case = {'type': 'sandwich', 'holes': mount_holes_num, 'hole_diameter': mount_holes_size, 'x_holes':0, 'y_holes':0}
         elif self.case['type']:
-            log.error('Unknown case type: %s, skipping case generation', self.case['type'])
+            self.error('unknown_case_type', 'Unknown case type: %s, skipping case generation', self.case['type'])
 
         if reinforcing and 'reinforcing' not in self.layers:
             self.layers.append('reinforcing')
 
         # Determine the size of each key
-        self.parse_layout()
+        with self.timer('parse_layout'):
+            self.parse_layout()
+
+    def __getstate__(self):
+        # The progress callback and the FreeCAD document stay in the process that started the build
+        return dict(self.__dict__, progress=None, document=None)
+
+    def build(self, only=None, jobs=1, progress=None):
+        """Create and export every layer of the case, or just the `only` layer.
+
+        With jobs > 1 the layers are built at the same time in a pool of that
+        many processes. `progress(event)` is called as the build goes, see
+        report(). Returns the manifest of the build.
+        """
+        build_start = time.time()
+        self.progress = progress
+        self.memory = {'start_mb': rss_mb()}
+        max_rss = peak_rss_mb()
+        layers = [layer for layer in SHAPE_LAYERS + SWITCH_LAYERS if layer in self.layers and (not only or only == layer)]
+
+        if self.layer_cache:
+            for layer in layers:
+                if self.load_cached_layer(layer):
+                    self.report('layer', layer=layer, exports=self.exports[layer], width=self.width, height=self.height)
+            layers = [layer for layer in layers if layer not in self.layers_cached]
+
+        if jobs > 1 and len(layers) > 1:
+            # Start the switch layers first, they take the longest
+            layers.sort(key=lambda layer: layer not in SWITCH_LAYERS)
+            pool = multiprocessing.Pool(min(jobs, len(layers)))
+            try:
+                for layer, exports, timings, boolean_ops, errors, memory in pool.imap_unordered(_build_layer, [(self, layer) for layer in layers]):
+                    self.exports[layer] = exports
+                    self.add_timings(timings)
+                    self.boolean_ops += boolean_ops
+                    self.errors.extend(error for error in errors if error not in self.errors)
+                    if memory is not None:
+                        self.sample_memory(memory)
+                    self.report('layer', layer=layer, exports=exports, width=self.width, height=self.height)
+                    if self.layer_cache:
+                        self.save_cached_layer(layer)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            if self.incremental:
+                self.load_snapshot()
+            try:
+                for layer in layers:
+                    plate = self.create_layer(layer)
+                    self.export(plate, layer)
+                    self.sample_memory()
+                    self.report('layer', layer=layer, exports=self.exports[layer], width=self.width, height=self.height)
+                    if self.layer_cache:
+                        self.save_cached_layer(layer)
+                    if self.incremental:
+                        self.plates[layer] = plate
+            finally:
+                self.close_document()
+            log.info('Intermediate plates: {computed} computed, {reused} reused'.format(**self.stage_stats))
+            if self.incremental:
+                self.save_snapshot()
+        self.build_seconds = time.time() - build_start
+
+        # Anything still held once the document is gone is kept by the process for the next build
+        gc.collect()
+        if peak_rss_mb() > max_rss:
+            self.sample_memory(peak_rss_mb())  # The build pushed the process past its old peak
+        self.memory['end_mb'] = rss_mb()
+        self.sample_memory(self.memory['end_mb'])
+        if self.memory['start_mb'] is not None and self.memory['end_mb'] is not None:
+            self.memory['retained_mb'] = self.memory['end_mb'] - self.memory['start_mb']
+            log.info('Memory: %.1f MB peak, %.1f MB retained', self.memory['peak_mb'], self.memory['retained_mb'])
+
+        return self.manifest()
+
+    def create_layer(self, layer):
+        """Create a layer by name.
+        """
+        with self.timer('create_%s_layer' % layer):
+            if self.previous and layer in self.previous['layers']:
+                plate = self.reuse_layer(layer)
+                if plate is not None:
+                    return plate
+
+            if layer in SWITCH_LAYERS:
+                return self.create_switch_layer(layer)
+
+            create_layer = {
+                'simple': self.init_plate,
+                'bottom': self.create_bottom_layer,
+                'closed': self.create_closed_layer,
+                'open': self.create_open_layer,
+            }[layer]
+
+            return create_layer(oversize=self.oversize_distance if layer in self.oversize else 0)
+
+    def manifest(self):
+        """Return a summary of the case and the files that have been exported.
+        """
+        return {
+            'formats': self.formats,
+            'plates': self.layers,
+            'exports': self.exports,
+            'width': self.width,
+            'height': self.height,
+            'inside_width': self.inside_width,
+            'inside_height': self.inside_height,
+            'case_type': self.case['type'],
+            'errors': self.errors,
+            'incremental': {
+                'previous': self.previous['export_basename'] if self.previous else None,
+                'keys': len(self.keys),
+                'keys_reused': self.keys_reused,
+                'layers_reused': self.layers_reused
+            },
+            'layers_cached': self.layers_cached,
+            'timings': {
+                'seconds': getattr(self, 'build_seconds', None),
+                'stages': self.timings,
+                'boolean_ops': self.boolean_ops,
+                'memory': dict((key, round(value, 1)) for key, value in self.memory.items() if value is not None)
+            }
+        }
+
+    def load_snapshot(self):
+        """Find the snapshot of the last build with the same settings and plate size as this one.
+        """
+        with self.timer('load_snapshot'):
+            self.snapshot_key = incremental.fingerprint(self)
+            self.previous = incremental.Snapshots(config.app['incremental_dir'], config.app['incremental_snapshots']).load(self.snapshot_key)
+        if self.previous:
+            log.info('Patching the plates from the last build of %s', self.previous['export_basename'])
+            for kind in self.previous['errors']:
+                if kind not in self.errors:
+                    self.errors.append(kind)
+
+    def save_snapshot(self):
+        """Save the layers we built so the next build like this one can patch them.
+        """
+        with self.timer('save_snapshot'):
+            layers = dict(self.previous['layers']) if self.previous else {}
+            for layer, plate in self.plates.items():
+                if layer in SWITCH_LAYERS:
+                    layers[layer] = {'plate': plate, 'cutouts': self.snapshot_cutouts[layer]}
+                else:
+                    layers[layer] = {'plate': plate}
+
+            snapshot = {
+                'export_basename': self.export_basename,
+                'keys': [key.fingerprint() for key in self.keys],
+                'errors': [kind for kind in self.errors if kind in incremental.BASE_ERRORS],
+                'layers': layers
+            }
+            incremental.Snapshots(config.app['incremental_dir'], config.app['incremental_snapshots']).save(self.snapshot_key, snapshot)
+
+    def reuse_layer(self, layer):
+        """Return a layer from the previous build, patched to match this layout.
+
+        Returns None if the layer has to be drawn from scratch.
+        """
+        previous = self.previous['layers'][layer]
+        if layer not in SWITCH_LAYERS:
+            self.layers_reused.append(layer)
+            return copy_plate(previous['plate'])
+
+        cutouts = self.snapshot_cutouts[layer] = self.labeled_cutouts(layer)
+        with self.timer('patch_layer'):
+            patched = incremental.patch(previous['plate'], previous['cutouts'], cutouts)
+        if patched is None:
+            log.info('Changed keys reach the edge of the %s layer, drawing it from scratch', layer)
+            return None
+
+        plate, recut = patched
+        if recut:
+            self.boolean_ops += 1
+        else:
+            self.layers_reused.append(layer)
+        self.keys_reused[layer] = sum(1 for key in self.keys if key.fingerprint() not in recut)
+        log.info('Reused %d of %d keys in the %s layer', self.keys_reused[layer], len(self.keys), layer)
+
+        return plate
+
+    def layer_key(self, layer):
+        """Return a hash of everything a shape layer is drawn and exported from, or None for the switch based layers.
+        """
+        if layer not in LAYER_SETTINGS:
+            return None
+
+        settings = dict((name, getattr(self, name)) for name in LAYER_SETTINGS[layer])
+        settings.update({
+            'layer': layer,
+            'case': dict((name, value) for name, value in self.case.items() if name not in ('x_holes', 'y_holes')),  # Worked out while drawing
+            'oversize': self.oversize_distance if layer in self.oversize else 0,
+            'usb': layer in self.usb_layers,
+            'formats': self.formats,
+            'native_export': self.native_export,
+            'stl': (self.stl_deflection, self.stl_angle) if 'stl' in self.formats else None
+        })
+
+        return hashlib.sha1(json.dumps([LAYER_CACHE_VERSION, settings], sort_keys=True)).hexdigest()
+
+    def load_cached_layer(self, layer):
+        """Copy the files for a layer from an earlier build that shared it, returns True if we could.
+        """
+        key = self.layer_key(layer)
+        if key is None:
+            return False
+
+        pwd_len = len(config.app['pwd'])
+        with self.timer('load_cached_layer'):
+            info = self.layer_cache.get(key, lambda format: "%s/%s_%s.%s" % (config.app['export'], layer, self.export_basename, format))
+        if info is None:
+            return False
+
+        self.exports[layer] = [dict(export, url='%s/%s_%s.%s' % (config.app['export'][pwd_len:], layer, self.export_basename, export['name'])) for export in info['exports']]
+        for kind in info['errors']:
+            if kind not in self.errors:
+                self.errors.append(kind)
+        self.layers_cached.append(layer)
+        log.info('Copied the %s layer from the layer cache', layer)
+
+        return True
+
+    def save_cached_layer(self, layer):
+        """Add a layer we just exported to the layer cache.
+        """
+        key = self.layer_key(layer)
+        if key is None:
+            return
+
+        with self.timer('save_cached_layer'):
+            self.layer_cache.put(key, self.exports[layer], lambda format: "%s/%s_%s.%s" % (config.app['export'], layer, self.export_basename, format),
+                                 [kind for kind in self.errors if kind in incremental.BASE_ERRORS])
+
+    def labeled_cutouts(self, layer):
+        """Return the cutouts for a switch based layer as (label, cutout).
+
+        Cutouts for a key are labeled with the key's fingerprint, the rest with
+        their kind and how many of that kind came before them.
+        """
+        cutouts = []
+        counts = {}
+        for kind, key, cutout in self.layer_cutouts(layer):
+            if key is not None:
+                label = key.fingerprint()
+            else:
+                label = (kind, counts.get(kind, 0))
+                counts[kind] = label[1] + 1
+            cutouts.append((label, cutout))
+
+        return cutouts
+
+    def report(self, event, **fields):
+        """Pass a progress event to the progress callback, if there is one.
+
+        A `layer` event is sent with the exports of each layer as soon as it
+        has been exported, and `keys` events are sent while the keys of a
+        switch based layer are being cut. When the cuts are batched, a
+        `cutting` event is sent before the one cut and `keys` once it is done.
+        """
+        if self.progress:
+            self.progress(dict(fields, event=event))
+
+    def error(self, kind, message, *args):
+        """Log a problem with the build and remember what kind of problem it was.
+        """
+        log.error(message, *args)
+        if kind not in self.errors:
+            self.errors.append(kind)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Add the wall and CPU time spent inside a `with` block to the timings for a stage.
+        """
+        wall, cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            self.add_timings({stage: {'wall': time.time() - wall, 'cpu': time.clock() - cpu, 'calls': 1}})
+
+    def add_timings(self, timings):
+        """Add the timings from another part of the build, EG a layer built in another process.
+        """
+        for stage, timing in timings.items():
+            total = self.timings.setdefault(stage, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            for key in ('wall', 'cpu', 'calls'):
+                total[key] += timing[key]
+
+    def sample_memory(self, rss=None):
+        """Raise the peak memory of the build to the RSS of this process, or to `rss` from a layer's process.
+        """
+        rss = rss_mb() if rss is None else rss
+        if rss is not None:
+            self.memory['peak_mb'] = max(self.memory.get('peak_mb', 0), rss)
+
+    def open_document(self):
+        """Return the FreeCAD document this case exports its layers from, creating it the first time.
+
+        Each build gets a document of its own rather than sharing the
+        ActiveDocument with the builds before it, see close_document().
+        """
+        if self.document is None:
+            self.document = startup.load('FreeCAD').newDocument('kb_build')  # FreeCAD makes the name unique
+
+        return self.document
+
+    def close_document(self):
+        """Close the FreeCAD document so the shapes in it can be freed.
+        """
+        if self.document is not None:
+            startup.load('FreeCAD').closeDocument(self.document.Name)
+            self.document = None
 
     def create_bottom_layer(self, oversize=0):
         """Returns a copy of the bottom layer ready to export.
@@ -151,6 +544,11 @@ class KeyboardCase(object):
 
     def create_closed_layer(self, oversize=0):
         """Returns a copy of the closed layer ready to export.
+        """
+        return self.stage('closed', oversize, self.draw_closed_layer)
+
+    def draw_closed_layer(self, oversize=0):
+        """Draw the closed layer, the open layer is built on top of it.
 
         We stash nifty things like the feet in the closed layer.
         """
@@ -192,6 +590,7 @@ class KeyboardCase(object):
             distance_moved += 15
 
         plate = plate.center(-left_edge-distance_moved,-top_edge).cutThruAll()  # Return to center and cut
+        self.boolean_ops += 1
 
         return plate
 
@@ -208,54 +607,40 @@ class KeyboardCase(object):
 
         The switch based layers are `switch`, `reinforcing`, and `top`.
         """
-        prev_width = None
-        prev_y_off = 0
         oversize = self.oversize_distance if layer in self.oversize else 0
 
         plate = self.init_plate(oversize=oversize)
-        plate = self.center(plate, -self.width/2, -self.height/2) # move to top left of the plate
+
+        if self.incremental:
+            # The snapshot needs the labeled cutouts, so cut the layer from them rather than placing every key twice
+            if layer not in self.snapshot_cutouts:
+                self.snapshot_cutouts[layer] = self.labeled_cutouts(layer)
+            cutouts = [cutout for label, cutout in self.snapshot_cutouts[layer] if label[0] != 'mount_hole']  # The base plate has those
+            self.report('cutting', layer=layer, cutouts=len(cutouts))
+            with self.timer('cut_batch'):
+                self.boolean_ops += 1
+                plate = plate.cut_cutouts(cutouts)
+            self.report('keys', layer=layer, done=len(self.keys), total=len(self.keys))
+            return plate
 
         if layer != 'top':
             # Put holes into switch/reinforcing plates
+            plate = self.center(plate, -self.width/2, -self.height/2) # move to top left of the plate
             plate = self.cut_switch_plate_holes(plate)
 
-        for r, row in enumerate(self.layout):
-            for k, key in enumerate(row):
-                x, y, kx = 0, 0, 0
-                if 'x' in key:
-                    x = key['x']*KEY_UNIT
-                    kx = x
-
-                if 'y' in key and k == 0:
-                    y = key['y']*KEY_UNIT
-
-                if r == 0 and k == 0: # handle placement of the first key in first row
-                    plate = self.center(plate, (key['w'] * KEY_UNIT / 2), (KEY_UNIT / 2))
-                    x += (self.x_pad+self.x_pcb_pad)
-                    y += (self.y_pad+self.y_pcb_pad)
-                    # set x_off negative since the 'cut_switch' will append 'x' and we need to account for initial spacing
-                    self.x_off = -(x - (KEY_UNIT/2 + key['w']*KEY_UNIT/2) - kx)
-                elif k == 0: # handle changing rows
-                    plate = self.center(plate, -self.x_off, KEY_UNIT) # move to the next row
-                    self.x_off = 0 # reset back to the left side of the plate
-                    x += KEY_UNIT/2 + key['w']*KEY_UNIT/2
-                else: # handle all other keys
-                    x += prev_width*KEY_UNIT/2 + key['w']*KEY_UNIT/2
-
-                if prev_y_off != 0: # prev_y_off != 0
-                    y += -prev_y_off
-                    prev_y_off = 0
-
-                if 'h' in key and key['h'] > 1: # deal with vertical keys
-                    prev_y_off = key['h']*KEY_UNIT/2 - KEY_UNIT/2
-                    y += prev_y_off
-
-                # Cut the switch hole
-                plate = self.cut_switch(plate, (x, y), key, layer)
-                prev_width = key['w']
+        last_report = time.time()
+        for i, key in enumerate(self.keys):
+            plate = self.cut_switch(plate, key, layer)
+            if not self.batch_cuts and time.time() - last_report >= PROGRESS_INTERVAL:
+                self.report('keys', layer=layer, done=i + 1, total=len(self.keys))
+                last_report = time.time()
+        if self.batch_cuts:
+            # The keys have only been placed, the time goes into the one cut below
+            self.report('cutting', layer=layer, cutouts=len(self.cutouts))
 
         plate = self.recenter(plate)
-        plate = self.cut_usb_hole(plate, layer, oversize=oversize)
+        plate = self.cut_usb_hole(plate, layer, oversize=oversize)  # Also cuts any batched cutouts
+        self.report('keys', layer=layer, done=len(self.keys), total=len(self.keys))
         return plate
 
     def cut_feet_holes(self, plate):
@@ -271,17 +656,25 @@ class KeyboardCase(object):
                 (self.foot_hole_square/2, self.foot_hole_square/2)
             ]
             plate = self.center(plate, -self.width/2, -self.height/2) # move to top left of the plate
-            plate = self.center(plate, *foot_hole).circle(self.foot_hole_diameter/2).cutThruAll()  # Add screw hole
-            plate = plate.center(0, 59).polyline(points).center(0, -59)  # Add square hole
-            plate = self.recenter(plate).cutThruAll()
+            plate = self.center(plate, *foot_hole)
+            plate = self.cut(self.circle(plate, self.foot_hole_diameter/2))  # Add screw hole
+            plate = self.center(plate, 0, 59)
+            plate = self.polyline(plate, points)  # Add square hole
+            plate = self.center(plate, 0, -59)
+            plate = self.cut(self.recenter(plate))
 
         return plate
 
     def cut_usb_hole(self, plate, layer, oversize=0):
         """Cut the opening that allows for the USB hole.
         """
+        return self.cut_batch(self.draw_usb_hole(plate, layer, oversize=oversize))
+
+    def draw_usb_hole(self, plate, layer, oversize=0):
+        """Draw the opening that allows for the USB hole, if this layer has one.
+        """
         if layer not in self.usb_layers:
-            return plate.cutThruAll()
+            return plate
 
         points = [
             (-self.usb_outer_width/2+self.usb_offset, -(self.y_pad+self.y_pcb_pad+self.kerf*2)/2-oversize/2),
@@ -291,7 +684,8 @@ class KeyboardCase(object):
             (-self.usb_outer_width/2+self.usb_offset, -(self.y_pad+self.y_pcb_pad+self.kerf*2)/2-oversize/2)
         ]
         y_distance = -self.height / 2 + (self.y_pad + self.y_pcb_pad) / 2 - self.kerf*2
-        plate = plate.center(0, y_distance).polyline(points)
+        plate = self.center(plate, 0, y_distance)
+        plate = self.polyline(plate, points)
 
         if layer == 'bottom':
             points = [
@@ -301,9 +695,9 @@ class KeyboardCase(object):
                 (self.usb_inner_width/2+self.usb_offset, (self.y_pad+self.y_pcb_pad)/2+self.usb_height+self.kerf*3),   # yes it is
                 (self.usb_inner_width/2+self.usb_offset, (self.y_pad+self.y_pcb_pad)/2)
             ]
-            plate = plate.polyline(points)
+            plate = self.polyline(plate, points)
 
-        plate = plate.center(0, -y_distance).cutThruAll()
+        plate = self.center(plate, 0, -y_distance)
 
         return plate
 
@@ -312,43 +706,85 @@ class KeyboardCase(object):
         """
         for hole in self.holes:
             x, y, diameter = hole
-            plate = plate.center(x, y).circle((diameter/2)-self.kerf).center(-x, -y).cutThruAll()
+            plate = self.center(plate, x, y)
+            plate = self.circle(plate, (diameter/2)-self.kerf)
+            plate = self.cut(self.center(plate, -x, -y))
 
         return plate
 
     def parse_layout(self):
-        """Parse the supplied layout to determine size and populate the properties of each key
+        """Parse the supplied layout to determine its size and where each key goes.
+
+        Keys are placed by walking a cursor across the layout the same way
+        KLE does, so every Key knows the absolute position of its center.
+        The supplied layout is not modified.
         """
         layout_width = 0
         layout_height = 0
         key_desc = False # track if current is not a key and only describes the next key
+        cursor_x, cursor_y = 0, 0 # center of the current key from the top left of the plate
+        row_x = 0 # how far the cursor has moved across the current row
+        prev_width = None
+        prev_y_off = 0
         for row in self.keyboard_layout:
             if isinstance(row, list): # only handle arrays of keys
                 row_width = 0
                 row_height = 0
                 row_layout = []
                 for k in row:
-                    key = {}
                     if isinstance(k, dict): # descibes the next key
-                        key = k
-                        if 'w' not in key:
-                            key['w'] = 1
-                        if 'h' not in key:
-                            key['h'] = 1
-                        row_layout.append(key)
+                        properties = k
                         key_desc = True
-                    else: # is just a standard key (we know its a single unit key)
-                        if not key_desc: # only handle if it was not already handled as a key_desc
-                            key['w'] = 1
-                            key['h'] = 1
-                            row_layout.append(key)
+                    elif not key_desc: # is just a standard key (we know its a single unit key)
+                        properties = {}
+                    else: # was already handled as a key_desc
                         key_desc = False
-                    if 'w' in key:
-                        row_width += key['w']
-                    if 'x' in key:
-                        row_width += key['x'] # offsets count towards total row width
-                    if 'y' in key:
-                        row_height = key['y']
+                        continue
+
+                    width = properties.get('w', 1)
+                    row_width += width
+                    if 'x' in properties:
+                        row_width += properties['x'] # offsets count towards total row width
+                    if 'y' in properties:
+                        row_height = properties['y']
+
+                    # Move the cursor to the center of this key
+                    x, y, kx = 0, 0, 0
+                    if 'x' in properties:
+                        x = properties['x']*KEY_UNIT
+                        kx = x
+
+                    if 'y' in properties and not row_layout:
+                        y = properties['y']*KEY_UNIT
+
+                    if not self.layout and not row_layout: # handle placement of the first key in first row
+                        cursor_x, cursor_y = width*KEY_UNIT/2, KEY_UNIT/2
+                        x += (self.x_pad+self.x_pcb_pad)
+                        y += (self.y_pad+self.y_pcb_pad)
+                        # start row_x negative since we add 'x' below and we need to account for initial spacing
+                        row_x = -(x - (KEY_UNIT/2 + width*KEY_UNIT/2) - kx)
+                    elif not row_layout: # handle changing rows
+                        cursor_x, cursor_y = cursor_x - row_x, cursor_y + KEY_UNIT # move to the next row
+                        row_x = 0 # reset back to the left side of the plate
+                        x += KEY_UNIT/2 + width*KEY_UNIT/2
+                    else: # handle all other keys
+                        x += prev_width*KEY_UNIT/2 + width*KEY_UNIT/2
+
+                    if prev_y_off != 0:
+                        y += -prev_y_off
+                        prev_y_off = 0
+
+                    if properties.get('h', 1) > 1: # deal with vertical keys
+                        prev_y_off = properties['h']*KEY_UNIT/2 - KEY_UNIT/2
+                        y += prev_y_off
+
+                    cursor_x, cursor_y = cursor_x + x, cursor_y + y
+                    row_x += x
+                    prev_width = width
+
+                    key = Key(cursor_x, cursor_y, properties)
+                    row_layout.append(key)
+                    self.keys.append(key)
                 self.layout.append(row_layout)
                 if row_width > layout_width:
                     layout_width = row_width
@@ -367,15 +803,26 @@ class KeyboardCase(object):
         self.vertical_edge = self.height / 2
 
     def init_plate(self, oversize=0):
-        """Return a basic plate with the features that are common to all layers.
+        """Return a copy of the basic plate with the features that are common to all layers.
+        """
+        with self.timer('init_plate'):
+            return self.stage('base', oversize, self.draw_plate)
+
+    def draw_plate(self, oversize=0):
+        """Draw a basic plate with the features that are common to all layers.
 
         If oversize is greater than 0 the layer will be made that many mm larger than default, while keeping screws in the same position.
         """
-        plate = cadquery.Workplane("front").box(self.width+self.kerf*2+oversize, self.height+self.kerf*2+oversize, self.thickness)
+        self.origin = (0,0)
+        if self.flat:
+            plate = plate2d.Plate(self.width+self.kerf*2+oversize, self.height+self.kerf*2+oversize, self.thickness)
+        else:
+            plate = startup.load('cadquery').Workplane("front").box(self.width+self.kerf*2+oversize, self.height+self.kerf*2+oversize, self.thickness)
 
         # Cut the corners if necessary
         if self.corners > 0 and self.corner_type == 'round':
             plate = plate.edges("|Z").fillet(self.corners)
+            self.boolean_ops += 1
 
         plate = plate.faces("<Z").workplane()
 
@@ -386,38 +833,54 @@ class KeyboardCase(object):
                     (self.horizontal_edge, self.vertical_edge - self.corners), (self.horizontal_edge, self.vertical_edge),
                     (self.horizontal_edge - self.corners, self.vertical_edge), (self.horizontal_edge, self.vertical_edge - self.corners),
                 )
-                plate = plate.polyline(points)
+                plate = self.polyline(plate, points)
                 # Lower left corner
                 points = (
                     (-self.horizontal_edge, self.vertical_edge - self.corners), (-self.horizontal_edge, self.vertical_edge),
                     (-self.horizontal_edge + self.corners, self.vertical_edge), (-self.horizontal_edge, self.vertical_edge - self.corners),
                 )
-                plate = plate.polyline(points)
+                plate = self.polyline(plate, points)
                 # Upper right corner
                 points = (
                     (self.horizontal_edge, -self.vertical_edge + self.corners), (self.horizontal_edge, -self.vertical_edge),
                     (self.horizontal_edge - self.corners, -self.vertical_edge), (self.horizontal_edge, -self.vertical_edge + self.corners),
                 )
-                plate = plate.polyline(points)
+                plate = self.polyline(plate, points)
                 # Upper left corner
                 points = (
                     (-self.horizontal_edge, -self.vertical_edge + self.corners), (-self.horizontal_edge, -self.vertical_edge),
                     (-self.horizontal_edge + self.corners, -self.vertical_edge), (-self.horizontal_edge, -self.vertical_edge + self.corners),
                 )
-                plate = plate.polyline(points)
+                plate = self.polyline(plate, points)
             elif self.corner_type != 'round':
-                log.error('Unknown corner type %s!', self.corner_type)
+                self.error('unknown_corner_type', 'Unknown corner type %s!', self.corner_type)
+
+        plate = self.draw_mount_holes(plate)
+
+        self.origin = (0,0)
+        return self.cut_batch(plate)
 
-        # Cut the mount holes in the plate
+    def draw_mount_holes(self, plate):
+        """Draw the holes for mounting the plate in a case, starting and ending at the center of the plate.
+        """
         if self.case['type'] == 'poker':
             hole_points = [(-139,9.2), (-117.3,-19.4), (-14.3,0), (48,37.9), (117.55,-19.4), (139,9.2)] # holes
             rect_center = (self.width/2) - (3.5/2)
             rect_points = [(rect_center,9.2), (-rect_center,9.2)] # edge slots
             rect_size = (3.5-self.kerf, 5-self.kerf) # edge slot cutout to edge
             for c in hole_points:
-                plate = plate.center(c[0], c[1]).hole(self.case['hole_diameter'] - self.kerf).center(-c[0],-c[1])
+                plate = self.center(plate, c[0], c[1])
+                plate = self.circle(plate, (self.case['hole_diameter'] - self.kerf)/2.0)
+                plate = self.center(plate, -c[0], -c[1])
             for c in rect_points:
-                plate = plate.center(c[0], c[1]).rect(*rect_size).center(-c[0],-c[1])
+                points = [
+                    (c[0]+rect_size[0]/2.0, c[1]+rect_size[1]/2.0),
+                    (c[0]-rect_size[0]/2.0, c[1]+rect_size[1]/2.0),
+                    (c[0]-rect_size[0]/2.0, c[1]-rect_size[1]/2.0),
+                    (c[0]+rect_size[0]/2.0, c[1]-rect_size[1]/2.0),
+                    (c[0]+rect_size[0]/2.0, c[1]+rect_size[1]/2.0)
+                ]
+                plate = self.polyline(plate, points)
         elif self.case['type'] == 'sandwich':
             plate = self.center(plate, -self.width/2 + self.kerf, -self.height/2 + self.kerf) # move to top left of the plate
             if 'holes' in self.case and self.case['holes'] >= 4 and 'x_holes' in self.case and 'y_holes' in self.case:
@@ -426,24 +889,74 @@ class KeyboardCase(object):
                 x_gap = (self.width - 2*self.case['hole_diameter'])/(self.case['x_holes'] + 1)
                 y_gap = (self.height - 2*self.case['hole_diameter'])/(self.case['y_holes'] + 1)
                 hole_distance = self.case['hole_diameter'] - self.kerf
-                plate = plate.center(hole_distance, hole_distance)
+                plate = self.center(plate, hole_distance, hole_distance)
                 for i in range(self.case['x_holes'] + 1):
-                    plate = plate.center(x_gap,0).circle(radius)
+                    plate = self.circle(self.center(plate, x_gap, 0), radius)
                 for i in range(self.case['y_holes'] + 1):
-                    plate = plate.center(0,y_gap).circle(radius)
+                    plate = self.circle(self.center(plate, 0, y_gap), radius)
                 for i in range(self.case['x_holes'] + 1):
-                    plate = plate.center(-x_gap,0).circle(radius)
+                    plate = self.circle(self.center(plate, -x_gap, 0), radius)
                 for i in range(self.case['y_holes'] + 1):
-                    plate = plate.center(0,-y_gap).circle(radius)
-                plate = plate.center(-hole_distance, -hole_distance)
+                    plate = self.circle(self.center(plate, 0, -y_gap), radius)
+                plate = self.center(plate, -hole_distance, -hole_distance)
             plate = self.center(plate, self.width/2 - self.kerf, self.height/2 - self.kerf) # move to center of the plate
         elif not self.case['type'] or self.case['type'] == 'reinforcing':
             pass
         else:
-            log.error('Unknown case type: %s', self.case['type'])
+            self.error('unknown_case_type', 'Unknown case type: %s', self.case['type'])
 
-        self.origin = (0,0)
-        return plate.cutThruAll()
+        return plate
+
+    def switch_cutouts(self):
+        """Return every cutout in the switch layer, except the USB opening, without drawing it.
+
+        Returns a list of (kind, key, cutout). kind is mount_hole, hole,
+        switch or stab, key is the Key a switch or stab is for, and cutout is
+        ('polyline', points) or ('circle', (x, y), radius) relative to the
+        center of the plate.
+        """
+        return [cutout for cutout in self.layer_cutouts('switch') if cutout[0] != 'usb']
+
+    def layer_cutouts(self, layer):
+        """Return every cutout in one of the switch based layers without drawing it.
+
+        The cutouts are in the order they are cut, and are returned the same
+        way as `switch_cutouts()` with usb as another kind.
+        """
+        oversize = self.oversize_distance if layer in self.oversize else 0
+        saved = self.batch_cuts, self.cutouts, self.origin
+        self.batch_cuts, self.cutouts, self.origin = True, [], (0,0)
+        owners = []
+        try:
+            plate = plate2d.Plate(self.width, self.height)  # Only used to keep track of where we are
+            plate = self.draw_mount_holes(plate)
+            owners += [('mount_hole', None)] * len(self.cutouts)
+            self.origin = (0,0)  # draw_plate does the same before the layer starts
+            if layer != 'top':
+                plate = self.center(plate, -self.width/2, -self.height/2)
+                plate = self.cut_switch_plate_holes(plate)
+                owners += [('hole', None)] * (len(self.cutouts) - len(owners))
+            for key in self.keys:
+                plate = self.cut_switch(plate, key, layer)
+                owners += [('switch', key)] + [('stab', key)] * (len(self.cutouts) - len(owners) - 1)
+            plate = self.recenter(plate)
+            plate = self.draw_usb_hole(plate, layer, oversize=oversize)
+            owners += [('usb', None)] * (len(self.cutouts) - len(owners))
+            recorded = self.cutouts
+        finally:
+            self.batch_cuts, self.cutouts, self.origin = saved
+
+        polylines = iter(transforms.transform_many(transforms.IDENTITY,
+                                                   [cutout[1] for cutout in recorded if cutout[0] == 'polyline'],
+                                                   [cutout[2] for cutout in recorded if cutout[0] == 'polyline']))
+        cutouts = []
+        for (kind, key), cutout in zip(owners, recorded):
+            if cutout[0] == 'circle':
+                cutouts.append((kind, key, cutout))
+            else:
+                cutouts.append((kind, key, ('polyline', next(polylines))))
+
+        return cutouts
 
     def layout_sandwich_holes(self):
         """Determine where screw holes should be placed.
@@ -469,7 +982,7 @@ class KeyboardCase(object):
                 self.case['x_holes'] = _x
                 self.case['y_holes'] = _y
             else:
-                log.error('Invalid hole configuration! Need at least 4 holes and must be divisible by 2!')
+                self.error('invalid_hole_count', 'Invalid hole configuration! Need at least 4 holes and must be divisible by 2!')
 
     def rotate_points(self, points, radians, rotate_point):
         """Rotate a sequence of points.
@@ -480,13 +993,7 @@ class KeyboardCase(object):
 
         rotate_point: the coordinate to rotate around
         """
-        def calculate_points(point):
-            return (
-                math.cos(math.radians(radians)) * (point[0]-rotate_point[0]) - math.sin(math.radians(radians)) * (point[1]-rotate_point[1]) + rotate_point[0],
-                math.sin(math.radians(radians)) * (point[0]-rotate_point[0]) + math.cos(math.radians(radians)) * (point[1]-rotate_point[1]) + rotate_point[1]
-            )
-
-        return map(calculate_points, points)
+        return rotate_points(points, radians, rotate_point)
 
     def draw_foot(self, plate):
         """Draw a foot at the current location.
@@ -511,490 +1018,62 @@ class KeyboardCase(object):
 
         return plate.polyline(points).wire()
 
-    def cut_switch(self, plate, switch_coord, key=None, layer='switch'):
+    def cut_switch(self, plate, key, layer='switch'):
         """Cut a switch opening
 
         plate: The plate object
 
-        switch_coord: Center of the switch
-
-        key: A dictionary describing this key, if not provided a 1u key at 0,0 will be used.
+        key: The Key to cut
 
         layer: The layer we're cutting
         """
-        if not key:
-            key = {}
-
-        width = key['w'] if 'w' in key else 1
-        height = key['h'] if 'h' in key else 1
-        switch_type = key['_t'] if '_t' in key else self.switch_type
-        stab_type = key['_s'] if '_s' in key else self.stab_type
-        kerf = key['_k']/2 if '_k' in key else self.kerf
-        rotate_key = key['_r'] if '_r' in key else None
-        rotate_stab = key['_rs'] if '_rs' in key else None
-        center_offset = key['_co'] if '_co' in key else False
-
-        # cut switch cutout
-        rotate = None
-        if 'h' in key and height > width:
-            rotate = True
-        points = []
-
-        # Standard locations with no offset
-        mx_height = 7 - kerf
-        mx_width = 7 - kerf
-        alps_height = 6.4 - kerf
-        alps_width = 7.8 - kerf
-        wing_inside = 2.9 + kerf
-        wing_outside = 6 - kerf
-        # FIXME: Use more descriptive names here
-        mx_stab_inside_y = 4.75 - kerf
-        mx_stab_inside_x = 8.575 + kerf
-        stab_cherry_top_x = 5.5 - kerf
-        stab_4 = 10.3 + kerf
-        stab_5 = 6.5 - kerf
-        stab_6 = 13.6 - kerf
-        mx_stab_outside_x = 15.225 - kerf
-        stab_y_wire = 2.3 - kerf
-        stab_bottom_y_wire = stab_y_wire - kerf
-        stab_9 = 16.1 - kerf
-        stab_cherry_wing_bottom_x = 0.5 - kerf
-        stab_cherry_bottom_x = 6.75 - kerf
-        stab_12 = 7.75 - kerf
-        stab_13 = 6 - kerf
-        stab_cherry_bottom_wing_bottom_y = 8 - kerf
-        stab_cherry_half_width = 3.325 - kerf
-        stab_cherry_bottom_wing_half_width = 1.65 - kerf
-        stab_cherry_outside_x = 4.2 - kerf
-        alps_stab_top_y = 4 + kerf
-        alps_stab_bottom_y = 9 - kerf
-        alps_stab_inside_x = (16.7 if width == 2.75 else 12.7) + kerf
-        alps_stab_ouside_x = alps_stab_inside_x + 2.7 - kerf*2
-
-        if layer == 'top':
-            # Cut out openings the size of keycaps
-            switch_type = 'mx'
-            stab_type = 'cherry'
-            if height > 1:
-                mx_width = (((KEY_UNIT/2) * height) + 0.5) - kerf
-            else:
-                mx_width = (((KEY_UNIT/2) * width) + 0.5) - kerf
-            mx_height = ((KEY_UNIT/2) + 0.5) - kerf
-        elif layer == 'reinforcing':
-            offset = 1
-            mx_height += offset
-            mx_width += offset
-            alps_height += offset
-            alps_width += offset
-            wing_inside += offset
-            wing_outside += offset
-            mx_stab_inside_x += offset
-            stab_cherry_top_x += 2.5 if offset < 2.5 else offset
-            stab_y_wire = mx_stab_inside_y = stab_cherry_top_x
-            stab_4 += offset
-            stab_5 += offset
-            stab_6 += offset
-            mx_stab_outside_x += offset
-            stab_9 += offset
-            stab_cherry_bottom_x += 4.28 - kerf if offset < 4.28 else offset
-            stab_cherry_wing_bottom_x = stab_bottom_y_wire = stab_cherry_bottom_wing_bottom_y = stab_13 = stab_12 = stab_cherry_bottom_x
-            stab_cherry_half_width += offset
-            stab_cherry_bottom_wing_half_width += offset
-            stab_cherry_outside_x += offset
-            alps_stab_top_y -= offset
-            alps_stab_bottom_y += offset
-            alps_stab_inside_x -= offset
-            alps_stab_ouside_x += offset
-
-        # Figure out our stabs now in case the switch itself is offset.
-        length = width
-        if rotate:
-            length = height
-
-        if length >= 2:
-            x = STABILIZERS[length][0] if length in STABILIZERS else STABILIZERS[2][0]
-            if not center_offset:
-                center_offset = STABILIZERS[length][1] if length in STABILIZERS else 0
-
-        if center_offset > 0:
-            # If the user has specified an offset stab (EG, 6U) we first move
-            # to cut the offset switch hole, and later will move back to cut
-            # the stabilizer.
-            plate = plate.center(center_offset, 0)
-
-        if switch_type == 'mx':
-            points = [
-                (mx_width+self.grow_x,-mx_height-self.grow_y),
-                (mx_width+self.grow_x,mx_height+self.grow_y),
-                (-mx_width-self.grow_x,mx_height+self.grow_y),
-                (-mx_width-self.grow_x,-mx_height-self.grow_y),
-                (mx_width+self.grow_x,-mx_height-self.grow_y)
-            ]
-        elif switch_type == 'alpsmx':
-            points = [
-                (mx_width,-mx_height),
-                (mx_width,-alps_height),
-                (alps_width,-alps_height),
-                (alps_width,alps_height),
-                (mx_width,alps_height),
-                (mx_width,mx_height),
-                (-mx_width,mx_height),
-                (-mx_width,alps_height),
-                (-alps_width,alps_height),
-                (-alps_width,-alps_height),
-                (-mx_width,-alps_height),
-                (-mx_width,-mx_height),
-                (mx_width,-mx_height)
-            ]
-        elif switch_type == 'mx-open':
-            points = [
-                (mx_width,-mx_height),
-                (mx_width,-wing_outside),
-                (alps_width,-wing_outside),
-                (alps_width,-wing_inside),
-                (mx_width,-wing_inside),
-                (mx_width,wing_inside),
-                (alps_width,wing_inside),
-                (alps_width,wing_outside),
-                (mx_width,wing_outside),
-                (mx_width,mx_height),
-                (-mx_width,mx_height),
-                (-mx_width,wing_outside),
-                (-alps_width,wing_outside),
-                (-alps_width,wing_inside),
-                (-mx_width,wing_inside),
-                (-mx_width,-wing_inside),
-                (-alps_width,-wing_inside),
-                (-alps_width,-wing_outside),
-                (-mx_width,-wing_outside),
-                (-mx_width,-mx_height),
-                (mx_width,-mx_height)
-            ]
-        elif switch_type == 'mx-open-rotatable':
-            points = [
-                (mx_width,-mx_height),
-                (mx_width,-wing_outside),
-                (alps_width,-wing_outside),
-                (alps_width,-wing_inside),
-                (mx_width,-wing_inside),
-                (mx_width,wing_inside),
-                (alps_width,wing_inside),
-                (alps_width,wing_outside),
-                (mx_width,wing_outside),
-                (mx_width,mx_height),
-                (wing_outside,mx_height),
-                (wing_outside,alps_width),
-                (wing_inside,alps_width),
-                (wing_inside,mx_height),
-                (-wing_inside,mx_height),
-                (-wing_inside,alps_width),
-                (-wing_outside,alps_width),
-                (-wing_outside,mx_height),
-                (-mx_width,mx_height),
-                (-mx_width,wing_outside),
-                (-alps_width,wing_outside),
-                (-alps_width,wing_inside),
-                (-mx_width,wing_inside),
-                (-mx_width,-wing_inside),
-                (-alps_width,-wing_inside),
-                (-alps_width,-wing_outside),
-                (-mx_width,-wing_outside),
-                (-mx_width,-mx_height),
-                (-wing_outside,-mx_height),
-                (-wing_outside,-alps_width),
-                (-wing_inside,-alps_width),
-                (-wing_inside,-mx_height),
-                (wing_inside,-mx_height),
-                (wing_inside,-alps_width),
-                (wing_outside,-alps_width),
-                (wing_outside,-mx_height),
-                (mx_width,-mx_height)
-            ]
-        elif switch_type == 'alps':
-            points = [
-                (alps_width,-alps_height),
-                (alps_width,alps_height),
-                (-alps_width,alps_height),
-                (-alps_width,-alps_height),
-                (alps_width,-alps_height),
-            ]
-
-        if rotate:
-            points = self.rotate_points(points, 90, (0,0))
-        if rotate_key:
-            points = self.rotate_points(points, rotate_key, (0,0))
-
-        plate = self.center(plate, switch_coord[0], switch_coord[1]).polyline(points).cutThruAll()
-
-        if center_offset > 0:
-            # Move back to the center of the key/stabilizer
-            plate = plate.center(-center_offset, 0)
-
-        # Cut stabilizers. We have different sections for 2U vs other sizes
-        # because cherry 2U stabs are shaped differently from larger stabs.
-        # This should be refactored for better readability.
-        if layer == 'top':
-            # Don't cut stabs on top
-            self.x_off += switch_coord[0]
-            return plate
+        profile = PROFILES.get(
+            key.switch_type if key.switch_type is not None else self.switch_type,
+            key.stab_type if key.stab_type is not None else self.stab_type,
+            key.w,
+            key.h,
+            key.kerf/2 if key.kerf is not None else self.kerf,
+            layer,
+            key.rotate_key,
+            key.rotate_stab,
+            key.center_offset if key.center_offset is not None else False,
+            self.grow_x,
+            self.grow_y
+        )
+        for error in profile.errors:
+            self.error('unsupported_profile', error)
+
+        # If the user has specified an offset stab (EG, 6U) we first move to
+        # cut the offset switch hole, and then move back to cut the stabilizer.
+        x, y = key.x - self.width/2, key.y - self.height/2
+        with self.timer('cut_switch.switch'):
+            plate = self.move_to(plate, x + profile.offset, y)
+            plate = self.cut(self.polyline(plate, profile.switch))
+            plate = self.move_to(plate, x, y)
+
+        if profile.stabs:
+            with self.timer('cut_switch.stab'):
+                for points in profile.stabs:
+                    plate = self.cut(self.polyline(plate, points))
 
-        elif (width >= 2 and width < 3) or (rotate and height >= 2 and height < 3):
-            # Cut 2 unit stabilizer cutout
-            if stab_type == 'cherry-costar':
-                points = [
-                    (mx_width,-mx_height),
-                    (mx_width,-mx_stab_inside_y),
-                    (mx_stab_inside_x,-mx_stab_inside_y),
-                    (mx_stab_inside_x,-stab_cherry_top_x),
-                    (stab_4,-stab_cherry_top_x),
-                    (stab_4,-stab_5),
-                    (stab_6,-stab_5),
-                    (stab_6,-stab_cherry_top_x),
-                    (mx_stab_outside_x,-stab_cherry_top_x),
-                    (mx_stab_outside_x,-stab_y_wire),
-                    (stab_9,-stab_y_wire),
-                    (stab_9,stab_cherry_wing_bottom_x),
-                    (mx_stab_outside_x,stab_cherry_wing_bottom_x),
-                    (mx_stab_outside_x,stab_cherry_bottom_x),
-                    (stab_6,stab_cherry_bottom_x),
-                    (stab_6,stab_12),
-                    (stab_4,stab_12),
-                    (stab_4,stab_cherry_bottom_x),
-                    (mx_stab_inside_x,stab_cherry_bottom_x),
-                    (mx_stab_inside_x,stab_13),
-                    (mx_width,stab_13),
-                    (mx_width,mx_height),
-                    (-mx_width,mx_height),
-                    (-mx_width,stab_13),
-                    (-mx_stab_inside_x,stab_13),
-                    (-mx_stab_inside_x,stab_cherry_bottom_x),
-                    (-stab_4,stab_cherry_bottom_x),
-                    (-stab_4,stab_12),
-                    (-stab_6,stab_12),
-                    (-stab_6,stab_cherry_bottom_x),
-                    (-mx_stab_outside_x,stab_cherry_bottom_x),
-                    (-mx_stab_outside_x,stab_cherry_wing_bottom_x),
-                    (-stab_9,stab_cherry_wing_bottom_x),
-                    (-stab_9,-stab_y_wire),
-                    (-mx_stab_outside_x,-stab_y_wire),
-                    (-mx_stab_outside_x,-stab_cherry_top_x),
-                    (-stab_6,-stab_cherry_top_x),
-                    (-stab_6,-stab_5),
-                    (-stab_4,-stab_5),
-                    (-stab_4,-stab_cherry_top_x),
-                    (-mx_stab_inside_x,-stab_cherry_top_x),
-                    (-mx_stab_inside_x,-mx_stab_inside_y),
-                    (-mx_width,-mx_stab_inside_y),
-                    (-mx_width,-mx_height),
-                    (mx_width,-mx_height)
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0,0))
-                if rotate_stab:
-                    points = self.rotate_points(points, rotate_stab, (0,0))
-                plate = plate.polyline(points).cutThruAll()
-            elif stab_type == 'cherry':
-                points = [
-                    (mx_stab_inside_x,-mx_stab_inside_y),
-                    (mx_stab_inside_x,-stab_cherry_top_x),
-                    (mx_stab_outside_x,-stab_cherry_top_x),
-                    (mx_stab_outside_x,-stab_y_wire),
-                    (stab_9,-stab_y_wire),
-                    (stab_9,stab_cherry_wing_bottom_x),
-                    (mx_stab_outside_x,stab_cherry_wing_bottom_x),
-                    (mx_stab_outside_x,stab_cherry_bottom_x),
-                    (stab_6,stab_cherry_bottom_x),
-                    (stab_6,stab_cherry_bottom_wing_bottom_y),
-                    (stab_4,stab_cherry_bottom_wing_bottom_y),
-                    (stab_4,stab_cherry_bottom_x),
-                    (mx_stab_inside_x,stab_cherry_bottom_x),
-                    (mx_stab_inside_x,stab_13),
-                    (-mx_stab_inside_x,stab_13),
-                    (-mx_stab_inside_x,stab_cherry_bottom_x),
-                    (-stab_4,stab_cherry_bottom_x),
-                    (-stab_4,stab_cherry_bottom_wing_bottom_y),
-                    (-stab_6,stab_cherry_bottom_wing_bottom_y),
-                    (-stab_6,stab_cherry_bottom_x),
-                    (-mx_stab_outside_x,stab_cherry_bottom_x),
-                    (-mx_stab_outside_x,stab_cherry_wing_bottom_x),
-                    (-stab_9,stab_cherry_wing_bottom_x),
-                    (-stab_9,-stab_y_wire),
-                    (-mx_stab_outside_x,-stab_y_wire),
-                    (-mx_stab_outside_x,-stab_cherry_top_x),
-                    (-mx_stab_inside_x,-stab_cherry_top_x),
-                    (-mx_stab_inside_x,-mx_stab_inside_y),
-                    (mx_stab_inside_x,-mx_stab_inside_y),
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0,0))
-                if rotate_stab:
-                    points = self.rotate_points(points, rotate_stab, (0,0))
-                plate = plate.polyline(points).cutThruAll()
-            elif stab_type == 'costar':
-                points_l = [
-                    (-stab_4,-stab_5),
-                    (-stab_6,-stab_5),
-                    (-stab_6,stab_12),
-                    (-stab_4,stab_12),
-                    (-stab_4,-stab_5)
-                ]
-                points_r = [
-                    (stab_4,-stab_5),
-                    (stab_6,-stab_5),
-                    (stab_6,stab_12),
-                    (stab_4,stab_12),
-                    (stab_4,-stab_5)
-                ]
-                if rotate:
-                    points_l = self.rotate_points(points_l, 90, (0,0))
-                    points_r = self.rotate_points(points_r, 90, (0,0))
-                if rotate_stab:
-                    points_l = self.rotate_points(points_l, rotate_stab, (0,0))
-                    points_r = self.rotate_points(points_r, rotate_stab, (0,0))
-                plate = plate.polyline(points_l).cutThruAll()
-                plate = plate.polyline(points_r).cutThruAll()
-            elif stab_type in ('alps', 'matias'):
-                points_r = [
-                    (alps_stab_inside_x, alps_stab_top_y),
-                    (alps_stab_ouside_x, alps_stab_top_y),
-                    (alps_stab_ouside_x, alps_stab_bottom_y),
-                    (alps_stab_inside_x, alps_stab_bottom_y),
-                    (alps_stab_inside_x, alps_stab_top_y)
-                ]
-                points_l = [
-                    (-alps_stab_inside_x, alps_stab_top_y),
-                    (-alps_stab_ouside_x, alps_stab_top_y),
-                    (-alps_stab_ouside_x, alps_stab_bottom_y),
-                    (-alps_stab_inside_x, alps_stab_bottom_y),
-                    (-alps_stab_inside_x, alps_stab_top_y)
-                ]
+        return plate
 
-                if rotate:
-                    points_l = self.rotate_points(points_l, 90, (0,0))
-                    points_r = self.rotate_points(points_r, 90, (0,0))
-                if rotate_stab:
-                    points_l = self.rotate_points(points_l, rotate_stab, (0,0))
-                    points_r = self.rotate_points(points_r, rotate_stab, (0,0))
-                plate = plate.polyline(points_l).cutThruAll()
-                plate = plate.polyline(points_r).cutThruAll()
-            else:
-                log.error('Unknown stab type %s! No stabilizer cut', stab_type)
+    def stage(self, name, oversize, draw):
+        """Return a copy of an intermediate plate, drawing it the first time it is asked for.
 
-        # Cut larger stabilizer cutouts
-        elif (width >= 3) or (rotate and height >= 3):
-            if stab_type == 'cherry-costar':
-                points = [
-                    (x-stab_cherry_half_width,-stab_y_wire),
-                    (x-stab_cherry_half_width,-stab_cherry_top_x),
-                    (x-stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
-                    (x-stab_cherry_bottom_wing_half_width,-stab_5),
-                    (x+stab_cherry_bottom_wing_half_width,-stab_5),
-                    (x+stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
-                    (x+stab_cherry_half_width,-stab_cherry_top_x),
-                    (x+stab_cherry_half_width,-stab_y_wire),
-                    (x+stab_cherry_outside_x,-stab_y_wire),
-                    (x+stab_cherry_outside_x,stab_cherry_wing_bottom_x),
-                    (x+stab_cherry_half_width,stab_cherry_wing_bottom_x),
-                    (x+stab_cherry_half_width,stab_cherry_bottom_x),
-                    (x+stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
-                    (x+stab_cherry_bottom_wing_half_width,stab_12),
-                    (x-stab_cherry_bottom_wing_half_width,stab_12),
-                    (x-stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
-                    (x-stab_cherry_half_width,stab_cherry_bottom_x),
-                    (x-stab_cherry_half_width,stab_y_wire),
-                    (-x+stab_cherry_half_width,stab_y_wire),
-                    (-x+stab_cherry_half_width,stab_cherry_bottom_x),
-                    (-x+stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
-                    (-x+stab_cherry_bottom_wing_half_width,stab_12),
-                    (-x-stab_cherry_bottom_wing_half_width,stab_12),
-                    (-x-stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
-                    (-x-stab_cherry_half_width,stab_cherry_bottom_x),
-                    (-x-stab_cherry_half_width,stab_cherry_wing_bottom_x),
-                    (-x-stab_cherry_outside_x,stab_cherry_wing_bottom_x),
-                    (-x-stab_cherry_outside_x,-stab_y_wire),
-                    (-x-stab_cherry_half_width,-stab_y_wire),
-                    (-x-stab_cherry_half_width,-stab_cherry_top_x),
-                    (-x-stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
-                    (-x-stab_cherry_bottom_wing_half_width,-stab_5),
-                    (-x+stab_cherry_bottom_wing_half_width,-stab_5),
-                    (-x+stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
-                    (-x+stab_cherry_half_width,-stab_cherry_top_x),
-                    (-x+stab_cherry_half_width,-stab_y_wire),
-                    (x-stab_cherry_half_width,-stab_y_wire)
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0,0))
-                if rotate_stab:
-                    points = self.rotate_points(points, rotate_stab, (0,0))
-                plate = plate.polyline(points).cutThruAll()
-            elif stab_type == 'cherry':
-                points = [
-                    (x - stab_cherry_half_width, -stab_y_wire),#1
-                    (x - stab_cherry_half_width, -stab_cherry_top_x),#2
-                    (x + stab_cherry_half_width, -stab_cherry_top_x),#3
-                    (x + stab_cherry_half_width, -stab_y_wire),#4
-                    (x + stab_cherry_outside_x, -stab_y_wire),#5
-                    (x + stab_cherry_outside_x, stab_cherry_wing_bottom_x),#6
-                    (x + stab_cherry_half_width, stab_cherry_wing_bottom_x),#7
-                    (x + stab_cherry_half_width, stab_cherry_bottom_x),#8
-                    (x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#9
-                    (x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#10
-                    (x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#11
-                    (x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#12
-                    (x - stab_cherry_half_width, stab_cherry_bottom_x),#13
-                    (x - stab_cherry_half_width, stab_bottom_y_wire),#14
-                    (-x + stab_cherry_half_width, stab_bottom_y_wire),#15
-                    (-x + stab_cherry_half_width, stab_cherry_bottom_x),#16
-                    (-x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#17
-                    (-x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#18
-                    (-x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#19
-                    (-x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#20
-                    (-x - stab_cherry_half_width, stab_cherry_bottom_x),#21
-                    (-x - stab_cherry_half_width, stab_cherry_wing_bottom_x),#22
-                    (-x - stab_cherry_outside_x, stab_cherry_wing_bottom_x),#23
-                    (-x - stab_cherry_outside_x, -stab_y_wire),#24
-                    (-x - stab_cherry_half_width, -stab_y_wire),#25
-                    (-x - stab_cherry_half_width, -stab_cherry_top_x),#26
-                    (-x + stab_cherry_half_width, -stab_cherry_top_x),#27
-                    (-x + stab_cherry_half_width, -stab_y_wire),#28
-                    (x - stab_cherry_half_width, -stab_y_wire),#1
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0,0))
-                if rotate_stab:
-                    points = self.rotate_points(points, rotate_stab, (0,0))
-                plate = plate.polyline(points).cutThruAll()
-            elif stab_type in ('costar', 'matias'):
-                points_l = [
-                    (-x+stab_cherry_bottom_wing_half_width,-stab_5),
-                    (-x-stab_cherry_bottom_wing_half_width,-stab_5),
-                    (-x-stab_cherry_bottom_wing_half_width,stab_12),
-                    (-x+stab_cherry_bottom_wing_half_width,stab_12),
-                    (-x+stab_cherry_bottom_wing_half_width,-stab_5)
-                ]
-                points_r = [
-                    (x-stab_cherry_bottom_wing_half_width,-stab_5),
-                    (x+stab_cherry_bottom_wing_half_width,-stab_5),
-                    (x+stab_cherry_bottom_wing_half_width,stab_12),
-                    (x-stab_cherry_bottom_wing_half_width,stab_12),
-                    (x-stab_cherry_bottom_wing_half_width,-stab_5)
-                ]
-                if rotate:
-                    points_l = self.rotate_points(points_l, 90, (0,0))
-                    points_r = self.rotate_points(points_r, 90, (0,0))
-                if rotate_stab:
-                    points_l = self.rotate_points(points_l, rotate_stab, (0,0))
-                    points_r = self.rotate_points(points_r, rotate_stab, (0,0))
-                plate = plate.polyline(points_l).cutThruAll()
-                plate = plate.polyline(points_r).cutThruAll()
-            elif stab_type == 'alps':
-                # FIXME: Pull this in from your stashed patch
-                log.error('Vintage alps stabilizers for spacebar not implemented!')
-            else:
-                log.error('Unknown stab type %s! No stabilizer cut', stab_type)
+        Layers that start from the same plate (every layer starts from the
+        base plate, the open layer starts from the closed layer) share one
+        drawing of it per oversize.
+        """
+        key = (name, oversize)
+        if key in self.stages:
+            self.stage_stats['reused'] += 1
+        else:
+            self.stages[key] = (draw(oversize=oversize), self.origin)
+            self.stage_stats['computed'] += 1
+        plate, self.origin = self.stages[key]
 
-        self.x_off += switch_coord[0]
-        return plate
+        return copy_plate(plate)
 
     def recenter(self, plate):
         """Move back to the centerpoint of the plate
@@ -1004,6 +1083,11 @@ class KeyboardCase(object):
 
         return plate
 
+    def move_to(self, plate, x, y):
+        """Move to a point relative to the center of the plate.
+        """
+        return self.center(plate, x - self.origin[0], y - self.origin[1])
+
     def center(self, plate, x, y):
         """Move the center point and record how far we have moved relative to the center of the plate.
         """
@@ -1012,12 +1096,135 @@ class KeyboardCase(object):
 
         return plate.center(x, y)
 
+    def polyline(self, plate, points):
+        """Draw a cutout polygon at the current location.
+
+        When batching cuts the polygon is recorded relative to the center of the plate instead of being drawn.
+        """
+        if not self.batch_cuts:
+            return plate.polyline(points)
+
+        self.cutouts.append(('polyline', points, self.origin))
+        return plate
+
+    def circle(self, plate, radius):
+        """Draw a circular cutout centered on the current location.
+
+        When batching cuts the circle is recorded relative to the center of the plate instead of being drawn.
+        """
+        if not self.batch_cuts:
+            return plate.circle(radius)
+
+        self.cutouts.append(('circle', self.origin, radius))
+        return plate
+
+    def cut(self, plate):
+        """Cut the cutouts drawn so far through the plate.
+
+        When batching cuts this does nothing, the cutouts are cut together by `cut_batch`.
+        """
+        if not self.batch_cuts:
+            self.boolean_ops += 1
+            return plate.cutThruAll()
+
+        return plate
+
+    def cut_batch(self, plate):
+        """Cut all outstanding cutouts through the plate.
+
+        When batching cuts every recorded cutout is extruded into its own
+        solid and the whole set is subtracted with a single boolean cut. Each
+        cutout gets its own solid so that overlapping cutouts (EG, a switch
+        inside a cherry-costar stabilizer) are never mistaken for an island.
+        """
+        if not self.batch_cuts:
+            self.boolean_ops += 1
+            return plate.cutThruAll()
+
+        if not self.cutouts:
+            # Leave the plate's solid on the stack like cutThruAll() would, not the bare workplane
+            return plate if self.flat else plate.newObject([plate.findSolid()])
+
+        with self.timer('cut_batch'):
+            self.boolean_ops += 1
+            return self.cut_cutouts(plate)
+
+    def cut_cutouts(self, plate):
+        """Place the recorded cutouts on the plate and cut them all at once.
+        """
+        if self.flat:
+            matrix = transforms.IDENTITY
+        else:
+            # Cutouts are relative to the center of the plate, the workplane is relative to self.origin
+            plane = plate.plane
+            plane_matrix = (
+                (plane.xDir.x, plane.yDir.x, plane.origin.x),
+                (plane.xDir.y, plane.yDir.y, plane.origin.y),
+                (plane.xDir.z, plane.yDir.z, plane.origin.z),
+            )
+            matrix = transforms.compose(plane_matrix, transforms.translation(-self.origin[0], -self.origin[1]))
+
+        # Place every cutout on the plate in one go
+        polylines = [cutout for cutout in self.cutouts if cutout[0] == 'polyline']
+        polylines = iter(transforms.transform_many(matrix, [cutout[1] for cutout in polylines], [cutout[2] for cutout in polylines]))
+        circles = [cutout for cutout in self.cutouts if cutout[0] == 'circle']
+        circles = iter(transforms.transform(matrix, [cutout[1] for cutout in circles]))
+        cutouts = [('circle', next(circles), cutout[2]) if cutout[0] == 'circle' else ('polyline', next(polylines)) for cutout in self.cutouts]
+        self.cutouts = []
+
+        if self.flat:
+            return plate.cut_cutouts(cutouts)
+
+        cadquery = startup.load('cadquery')
+        depth = plane.zDir.multiply(-plate.largestDimension())
+        solids = []
+        for cutout in cutouts:
+            if cutout[0] == 'circle':
+                wire = cadquery.Wire.makeCircle(cutout[2], cadquery.Vector(*cutout[1]), plane.zDir)
+            else:
+                wire = cadquery.Wire.makePolygon([cadquery.Vector(*point) for point in cutout[1]])
+            solids.append(cadquery.Solid.extrudeLinear(wire, [], depth))
+
+        solid = plate.findSolid()
+        result = solid.cut(cadquery.Compound.makeCompound(solids))
+        solid.wrapped = result.wrapped
+
+        return plate.newObject([result])
+
+    def outline(self, plate):
+        """Yield the outline of a layer as (x, y, bulge) loops.
+        """
+        if self.flat:
+            for loop in plate.loops:
+                yield loop
+            return
+
+        for wire in plate.faces('<Z').val().wrapped.Wires:
+            yield wire_loop(wire)
+
+    def outline_bbox(self, plate):
+        """Return the (min_x, min_y, max_x, max_y) of a layer's outline.
+        """
+        if self.flat:
+            return (-plate.width/2, -plate.height/2, plate.width/2, plate.height/2)
+
+        box = plate.faces('<Z').val().wrapped.BoundBox
+        return (box.XMin, box.YMin, box.XMax, box.YMax)
+
+    def write_outline(self, writer, plate):
+        """Stream the outline of a layer through a DXFWriter or SVGWriter.
+        """
+        with writer:
+            writers.write_outline(writer, self.outline(plate))
+
+        return writer
+
     def __repr__(self):
         """Print out all KeyboardCase object configuration settings.
         """
         settings = {}
 
-        settings['plate_layout'] = self.layout
+        settings['plate_layout'] = [[key.as_dict() for key in row] for row in self.layout]
         settings['switch_type'] = self.switch_type
         settings['stabilizer_type'] = self.stab_type
         settings['case_type_and_holes'] = self.case
@@ -1034,44 +1241,211 @@ class KeyboardCase(object):
         """Export the specified layer to the formats specified in self.formats.
         """
         log.info("Exporting %s layer for %s", layer, self.export_basename)
-        # draw the part so we can export it
-        Part.show(plate.val().wrapped)
-        doc = FreeCAD.ActiveDocument
+        if not self.flat:
+            # draw the part so we can export it
+            with self.timer('export.show'):
+                doc = self.open_document()
+                doc.addObject('Part::Feature', layer).Shape = plate.val().wrapped
+                doc.recompute()
         # export the drawing into different formats
         pwd_len = len(config.app['pwd']) # the absolute part of the working directory (aka - outside the web space)
         self.exports[layer] = []
         if 'js' in self.formats:
-            with open("%s/%s_%s.js" % (config.app['export'], layer, self.export_basename), "w") as f:
-                cadquery.exporters.exportShape(plate, 'TJS', f)
-                self.exports[layer].append({'name': 'js', 'url': '%s/%s_%s.js' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-                log.info("Exported 'JS'")
+            with self.timer('export.js'):
+                with open("%s/%s_%s.js" % (config.app['export'], layer, self.export_basename), "w") as f:
+                    startup.load('cadquery').exporters.exportShape(plate, 'TJS', f)
+                    self.exports[layer].append({'name': 'js', 'url': '%s/%s_%s.js' % (config.app['export'][pwd_len:], layer, self.export_basename)})
+                    log.info("Exported 'JS'")
+        if 'mesh' in self.formats:
+            with self.timer('export.mesh'):
+                start = time.time()
+                positions, normals, indices = shape_mesh(plate.val().wrapped)
+                size = writers.write_mesh("%s/%s_%s.mesh" % (config.app['export'], layer, self.export_basename), positions, normals, indices)
+                self.exports[layer].append({'name': 'mesh', 'url': '%s/%s_%s.mesh' % (config.app['export'][pwd_len:], layer, self.export_basename)})
+                log.info("Exported 'MESH' (%d triangles, %d bytes in %.3fs)", len(indices) // 3, size, time.time() - start)
         if 'brp' in self.formats:
-            Part.export(doc.Objects, "%s/%s_%s.brp" % (config.app['export'], layer, self.export_basename))
-            self.exports[layer].append({'name': 'brp', 'url': '%s/%s_%s.brp' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-            log.info("Exported 'BRP'")
+            with self.timer('export.brp'):
+                startup.load('Part').export(doc.Objects, "%s/%s_%s.brp" % (config.app['export'], layer, self.export_basename))
+                self.exports[layer].append({'name': 'brp', 'url': '%s/%s_%s.brp' % (config.app['export'][pwd_len:], layer, self.export_basename)})
+                log.info("Exported 'BRP'")
         if 'stp' in self.formats:
-            Part.export(doc.Objects, "%s/%s_%s.stp" % (config.app['export'], layer, self.export_basename))
-            self.exports[layer].append({'name': 'stp', 'url': '%s/%s_%s.stp' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-            log.info("Exported 'STP'")
+            with self.timer('export.stp'):
+                startup.load('Part').export(doc.Objects, "%s/%s_%s.stp" % (config.app['export'], layer, self.export_basename))
+                self.exports[layer].append({'name': 'stp', 'url': '%s/%s_%s.stp' % (config.app['export'][pwd_len:], layer, self.export_basename)})
+                log.info("Exported 'STP'")
         if 'stl' in self.formats:
-            Mesh.export(doc.Objects, "%s/%s_%s.stl" % (config.app['export'], layer, self.export_basename))
-            self.exports[layer].append({'name': 'stl', 'url': '%s/%s_%s.stl' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-            log.info("Exported 'STL'")
+            with self.timer('export.stl'):
+                start = time.time()
+                export = {'name': 'stl', 'url': '%s/%s_%s.stl' % (config.app['export'][pwd_len:], layer, self.export_basename)}
+                if self.native_export:
+                    mesh = startup.load('MeshPart').meshFromShape(Shape=plate.val().wrapped, LinearDeflection=self.stl_deflection,
+                                                                  AngularDeflection=math.radians(self.stl_angle), Relative=False)
+                    points, facets = mesh.Topology
+                    points = [(point.x, point.y, point.z) for point in points]
+                    with writers.STLWriter("%s/%s_%s.stl" % (config.app['export'], layer, self.export_basename)) as writer:
+                        for a, b, c in facets:
+                            writer.triangle(points[a], points[b], points[c])
+                    export.update(triangles=writer.entities, bytes=writer.bytes)
+                    log.info("Exported 'STL' (%d triangles, %d bytes in %.3fs)", writer.entities, writer.bytes, time.time() - start)
+                else:
+                    startup.load('Mesh').export(doc.Objects, "%s/%s_%s.stl" % (config.app['export'], layer, self.export_basename))
+                    log.info("Exported 'STL' (%.3fs)", time.time() - start)
+                self.exports[layer].append(export)
         if 'dxf' in self.formats:
-            importDXF.export(doc.Objects, "%s/%s_%s.dxf" % (config.app['export'], layer, self.export_basename))
-            self.exports[layer].append({'name': 'dxf', 'url': '%s/%s_%s.dxf' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-            log.info("Exported 'DXF'")
+            with self.timer('export.dxf'):
+                start = time.time()
+                if self.native_export:
+                    writer = self.write_outline(writers.DXFWriter("%s/%s_%s.dxf" % (config.app['export'], layer, self.export_basename)), plate)
+                    log.info("Exported 'DXF' (%d entities, %d bytes in %.3fs)", writer.entities, writer.bytes, time.time() - start)
+                else:
+                    startup.load('importDXF').export(doc.Objects, "%s/%s_%s.dxf" % (config.app['export'], layer, self.export_basename))
+                    log.info("Exported 'DXF' (%.3fs)", time.time() - start)
+                self.exports[layer].append({'name': 'dxf', 'url': '%s/%s_%s.dxf' % (config.app['export'][pwd_len:], layer, self.export_basename)})
         if 'svg' in self.formats:
-            importSVG.export(doc.Objects, "%s/%s_%s.svg" % (config.app['export'], layer, self.export_basename))
-            self.exports[layer].append({'name': 'svg', 'url': '%s/%s_%s.svg' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-            log.info("Exported 'SVG'")
+            with self.timer('export.svg'):
+                start = time.time()
+                if self.native_export:
+                    writer = self.write_outline(writers.SVGWriter("%s/%s_%s.svg" % (config.app['export'], layer, self.export_basename), self.outline_bbox(plate)), plate)
+                    log.info("Exported 'SVG' (%d entities, %d bytes in %.3fs)", writer.entities, writer.bytes, time.time() - start)
+                else:
+                    startup.load('importSVG').export(doc.Objects, "%s/%s_%s.svg" % (config.app['export'], layer, self.export_basename))
+                    log.info("Exported 'SVG' (%.3fs)", time.time() - start)
+                self.exports[layer].append({'name': 'svg', 'url': '%s/%s_%s.svg' % (config.app['export'][pwd_len:], layer, self.export_basename)})
         if 'json' in self.formats and layer == 'switch':
-            with open("%s/%s_%s.json" % (config.app['export'], layer, self.export_basename), 'w') as json_file:
-                json_file.write(repr(self))
-            self.exports[layer].append({'name': 'json', 'url': '%s/%s_%s.json' % (config.app['export'][pwd_len:], layer, self.export_basename)})
-            log.info("Exported 'JSON'")
-
-        # remove all the documents from the view before we move on
-        for o in doc.Objects:
-            doc.removeObject(o.Label)
-
+            with self.timer('export.json'):
+                with open("%s/%s_%s.json" % (config.app['export'], layer, self.export_basename), 'w') as json_file:
+                    json_file.write(repr(self))
+                self.exports[layer].append({'name': 'json', 'url': '%s/%s_%s.json' % (config.app['export'][pwd_len:], layer, self.export_basename)})
+                log.info("Exported 'JSON'")
+
+        # remove the part from the document before we move on
+        if not self.flat:
+            for o in doc.Objects:
+                doc.removeObject(o.Name)
+
+
+def copy_plate(plate):
+    """Return a copy of a plate that can be cut without changing the original.
+    """
+    if isinstance(plate, plate2d.Plate):
+        return plate.copy()
+
+    return plate.newObject([plate.findSolid().copy()])
+
+
+def wire_loop(wire, deflection=0.01):
+    """Convert a FreeCAD wire into a loop of (x, y, bulge) vertices.
+
+    Lines and arcs are kept exact, any other curve is split into straight
+    edges that stray no more than `deflection` mm from it.
+    """
+    Part = startup.load('Part')
+    edges = wire.OrderedEdges
+    if len(edges) == 1 and isinstance(edges[0].Curve, Part.Circle):
+        center, radius = edges[0].Curve.Center, edges[0].Curve.Radius
+        return ((center.x+radius, center.y, 1.0), (center.x-radius, center.y, 1.0))
+
+    # Turn every edge into a list of (start, end, bulge) segments
+    segments = []
+    for edge in edges:
+        first, last = edge.FirstParameter, edge.LastParameter
+        if isinstance(edge.Curve, Part.Circle):
+            start, middle, end = edge.valueAt(first), edge.valueAt((first+last)/2), edge.valueAt(last)
+            dx, dy = end.x - start.x, end.y - start.y
+            bulge = 2 * ((middle.x - (start.x+end.x)/2)*dy - (middle.y - (start.y+end.y)/2)*dx) / (dx*dx + dy*dy)
+            segments.append([((start.x, start.y), (end.x, end.y), bulge)])
+        else:
+            points = [(point.x, point.y) for point in edge.discretize(Deflection=deflection)]
+            segments.append([(points[i], points[i+1], 0) for i in range(len(points)-1)])
+
+    # Edges are in order around the wire but may point either way along it
+    def distance(a, b):
+        return abs(a[0]-b[0]) + abs(a[1]-b[1])
+
+    def touches(point, edge):
+        return min(distance(point, edge[0][0]), distance(point, edge[-1][1]))
+
+    loop = []
+    for edge in segments:
+        if loop:
+            flip = distance(edge[0][0], loop[-1][1]) > distance(edge[-1][1], loop[-1][1])
+        elif len(segments) > 1:
+            flip = touches(edge[0][0], segments[1]) < touches(edge[-1][1], segments[1])
+        else:
+            flip = False
+        if flip:
+            edge = [(end, start, -bulge) for start, end, bulge in reversed(edge)]
+        loop.extend(edge)
+
+    return tuple((start[0], start[1], bulge) for start, end, bulge in loop)
+
+
+def shape_mesh(shape, tolerance=MESH_TOLERANCE):
+    """Tessellate a FreeCAD shape into flat lists of positions, normals and triangle indices.
+
+    Every face gets its own vertices so the edges of the plate stay sharp,
+    and each vertex normal is the average of the triangles in its face that
+    share it.
+    """
+    positions, normals, indices = [], [], []
+    for face in shape.Faces:
+        points, triangles = face.tessellate(tolerance)
+        points = [(point.x, point.y, point.z) for point in points]
+        start = len(positions) // 3
+        face_normals = [[0.0, 0.0, 0.0] for point in points]
+        for a, b, c in triangles:
+            (ax, ay, az), (bx, by, bz), (cx, cy, cz) = points[a], points[b], points[c]
+            ux, uy, uz, vx, vy, vz = bx - ax, by - ay, bz - az, cx - ax, cy - ay, cz - az
+            normal = (uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx)  # Weighted by the area of the triangle
+            for i in (a, b, c):
+                face_normals[i][0] += normal[0]
+                face_normals[i][1] += normal[1]
+                face_normals[i][2] += normal[2]
+            indices.extend((start + a, start + b, start + c))
+        for point, (nx, ny, nz) in zip(points, face_normals):
+            length = math.sqrt(nx*nx + ny*ny + nz*nz) or 1
+            positions.extend(point)
+            normals.extend((nx/length, ny/length, nz/length))
+
+    return positions, normals, indices
+
+
+def peak_rss_mb():
+    """Return the most memory this process has used since it started.
+    """
+    # Linux reports ru_maxrss in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _build_layer(args):
+    """Build and export a single layer in a worker process, returns (layer, exports, timings, boolean_ops, errors, rss_mb).
+    """
+    case, layer = args
+    case.timings, case.boolean_ops = {}, 0  # Only send back what this layer did
+    try:
+        case.export(case.create_layer(layer), layer)
+        memory = rss_mb()
+    finally:
+        case.close_document()  # The pool process goes on to build other layers
+
+    return layer, case.exports[layer], case.timings, case.boolean_ops, case.errors, memory
+
+
+def build_case(builder_args, only=None, export_dir=None, progress=None):
+    """Build the layers for a set of KeyboardCase arguments and return the manifest.
+
+    This is what the kb_web and kb_daemon worker processes run. `export_dir`
+    overrides where the files are written for this process, and `progress`
+    is passed on to KeyboardCase.build().
+    """
+    if export_dir:
+        config.app['export'] = export_dir
+
+    build_start = time.time()
+    log.info("Processing: %s", builder_args['export_basename'])
+    manifest = KeyboardCase(**builder_args).build(only=only, progress=progress)
+    log.info("Finished: %s", builder_args['export_basename'])
+    log.info("Processing took: %.2f seconds", time.time()-build_start)
+    log.info("Cutout profiles: {hits} hits, {misses} misses, {profiles} cached".format(**PROFILES.stats()))
+
+    return manifest
@@ -0,0 +1,210 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Content addressed cache of finished builds.
+
+Builds are keyed on the hash of the request that produced them. The cache
+keeps the response that was sent for each build along with the exported files
+that belong to it, and deletes the least recently used builds when the files
+take up more than `max_bytes`. The index is stored as JSON in the export
+directory so the cache survives restarts.
+
+The layers that don't depend on the keys are also cached on their own, so
+different layouts with the same case share them, see LayerCache.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger()
+
+
+class BuildCache(object):
+    """LRU cache of build results and their exported files.
+    """
+    def __init__(self, directory, max_bytes, index_name='build_cache.json'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(directory, index_name)
+        self.builds = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the index from disk, dropping builds whose files are gone.
+        """
+        if not os.path.exists(self.index_file):
+            return
+
+        try:
+            with open(self.index_file) as index_file:
+                builds = json.load(index_file)
+        except (IOError, ValueError) as e:
+            log.error('Could not read the build cache index %s: %s', self.index_file, e)
+            return
+
+        for key, build in builds:
+            if self.files_exist(build):
+                self.builds[key] = build
+                self.bytes += build['bytes']
+
+    def save(self):
+        """Write the index to disk, oldest build first.
+        """
+        temp_file = self.index_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as index_file:
+                json.dump(list(self.builds.items()), index_file)
+            os.rename(temp_file, self.index_file)
+        except (IOError, OSError) as e:
+            log.error('Could not write the build cache index %s: %s', self.index_file, e)
+
+    def files_exist(self, build):
+        return all(os.path.exists(os.path.join(self.directory, name)) for name in build['files'])
+
+    def get(self, key):
+        """Return the cached result for key, or None.
+
+        Recently used builds are reordered in memory and written out with the
+        next `put()`, so a hit never touches the disk beyond checking the
+        exported files are still there.
+        """
+        with self.lock:
+            build = self.builds.get(key)
+            if build is None or not self.files_exist(build):
+                if build is not None:
+                    self.bytes -= build['bytes']
+                    del self.builds[key]
+                self.misses += 1
+                return None
+
+            self.builds[key] = self.builds.pop(key)
+            self.hits += 1
+
+            return build['result']
+
+    def put(self, key, result, files):
+        """Cache the result of a build along with the names of the files it exported.
+        """
+        size = 0
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                log.error('Not caching %s, %s is missing', key, name)
+                return
+
+        with self.lock:
+            if key in self.builds:
+                self.bytes -= self.builds.pop(key)['bytes']
+            self.builds[key] = {'result': result, 'files': list(files), 'bytes': size}
+            self.bytes += size
+            self.evict()
+            self.save()
+
+    def evict(self):
+        """Delete the least recently used builds until we fit in max_bytes.
+        """
+        while self.bytes > self.max_bytes and len(self.builds) > 1:
+            key, build = self.builds.popitem(last=False)
+            self.bytes -= build['bytes']
+            for name in build['files']:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            log.info('Evicted build %s from the cache (%d bytes)', key, build['bytes'])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'builds': len(self.builds), 'bytes': self.bytes}
+
+
+class LayerCache(object):
+    """Exported files for the layers that many builds share, kept in a directory.
+
+    Each layer is a directory named after its key, holding a file for every
+    format it was exported to and a `layer.json` with its exports (without
+    their URLs) in the order they were written and the errors found while
+    drawing it. Files are
+    copied in and out, so a build's files always belong to that build and can
+    be rewritten or evicted without touching the cache. Only the
+    `max_layers` most recently used layers are kept.
+    """
+    def __init__(self, directory, max_layers=1000):
+        self.directory = directory
+        self.max_layers = max_layers
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, target):
+        """Copy the files for a layer to `target(format)` and return its info, or None.
+        """
+        info_file = os.path.join(self.path(key), 'layer.json')
+        if not os.path.exists(info_file):
+            return None
+
+        try:
+            with open(info_file) as info_fp:
+                info = json.load(info_fp)
+            for export in info['exports']:
+                shutil.copyfile(os.path.join(self.path(key), export['name']), target(export['name']))
+            os.utime(info_file, None)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.error('Could not copy the cached layer %s: %s', key, e)
+            return None
+
+        return info
+
+    def put(self, key, exports, target, errors):
+        """Cache the files for a layer's exports, copying each from `target(format)`.
+        """
+        if os.path.exists(self.path(key)):
+            return
+
+        temp_dir = '%s.%d.tmp' % (self.path(key), os.getpid())
+        try:
+            os.makedirs(temp_dir)
+            for export in exports:
+                shutil.copyfile(target(export['name']), os.path.join(temp_dir, export['name']))
+            with open(os.path.join(temp_dir, 'layer.json'), 'w') as info_fp:
+                exports = [dict((name, value) for name, value in export.items() if name != 'url') for export in exports]
+                json.dump({'exports': exports, 'errors': errors}, info_fp)
+            os.rename(temp_dir, self.path(key))
+        except (IOError, OSError) as e:
+            if not os.path.exists(self.path(key)):  # Another worker caching the same layer isn't a problem
+                log.error('Could not cache the layer %s: %s', key, e)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+
+        self.prune()
+
+    def prune(self):
+        """Delete the least recently used layers until we have max_layers.
+        """
+        try:
+            keys = [key for key in os.listdir(self.directory) if os.path.exists(os.path.join(self.path(key), 'layer.json'))]
+            keys.sort(key=lambda key: os.path.getmtime(os.path.join(self.path(key), 'layer.json')))
+            for key in keys[:-self.max_layers]:
+                shutil.rmtree(self.path(key), ignore_errors=True)
+        except OSError as e:
+            log.error('Could not prune the layer cache in %s: %s', self.directory, e)
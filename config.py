@@ -27,7 +27,17 @@ app = {
     'pwd': pwd,
     'static': os.path.join(pwd, 'static'),
     'export': os.path.join(pwd, 'static', 'exports'),
+    'export_cache_size': 1024*1024*1024,  # Bytes of exports kb_web keeps before evicting old builds
     'formats': ['dxf'],
+    'workers': None,  # Number of kb_web build processes, None for one per CPU
+    'max_jobs': 1000,  # Number of kb_web jobs to remember the status of
+    'worker_max_builds': 100,  # Builds a worker runs before it is replaced with a fresh process, None to never replace them
+    'worker_max_rss_mb': 2048,  # Replace a worker once a build leaves it using more than this many MB, None for no ceiling
+    'daemon_socket': os.path.join(os.path.abspath(pwd), 'kb_daemon.sock'),  # Where kb_daemon listens for kb_cli
+    'incremental_dir': os.path.join(pwd, 'incremental'),  # Snapshots of recent builds that edited layouts are patched from
+    'incremental_snapshots': 100,  # Number of snapshots to keep
+    'layer_cache_dir': os.path.join(pwd, 'layer_cache'),  # Exported layers that don't depend on the keys, shared between layouts
+    'layer_cache_size': 1000,  # Number of cached layers to keep
     'debug': False,
     'log': './kb_builder.log'
 }
@@ -38,11 +48,16 @@ lib = {
 }
 
 
-# Setup some environment stuff
-if lib.get('freecad_lib_dir'):
-    sys.path.append(lib['freecad_lib_dir'])
+def setup_freecad_path():
+    """Add FreeCAD's libraries and modules to sys.path.
 
-if lib.get('freecad_mod_dir'):
-    for mod in os.listdir(lib['freecad_mod_dir']):
-        mod_path = os.path.join(lib['freecad_mod_dir'], mod)
-        if os.path.isdir(mod_path): sys.path.append(mod_path)
+    This is called by startup.load() the first time a FreeCAD module is
+    needed, so builds that don't use FreeCAD don't pay for walking the mod dir.
+    """
+    if lib.get('freecad_lib_dir') and lib['freecad_lib_dir'] not in sys.path:
+        sys.path.append(lib['freecad_lib_dir'])
+
+    if lib.get('freecad_mod_dir'):
+        for mod in os.listdir(lib['freecad_mod_dir']):
+            mod_path = os.path.join(lib['freecad_mod_dir'], mod)
+            if os.path.isdir(mod_path) and mod_path not in sys.path: sys.path.append(mod_path)
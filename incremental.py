@@ -0,0 +1,207 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Rebuild a layout by patching the plates from the last build like it.
+
+Editing a layout usually changes a few keys. After a flat build the plates
+are saved as a snapshot, keyed on a fingerprint of everything except the keys
+(the case settings and the size of the plate). The next build with the same
+fingerprint reuses the layers that don't depend on the keys as they are, and
+patches the switch based layers: the holes left by the keys that changed are
+filled back in and only those keys are cut again.
+
+    snapshots = Snapshots(config.app['incremental_dir'], config.app['incremental_snapshots'])
+    snapshot = snapshots.load(fingerprint(case))
+    plate, recut = patch(snapshot['layers']['switch']['plate'], old_cutouts, new_cutouts)
+
+Only plate2d plates can be patched, builds that need a 3D model are always
+drawn from scratch.
+"""
+import cPickle
+import hashlib
+import json
+import logging
+import math
+import os
+
+import plate2d
+from preflight import Grid, distance_to_edge
+
+log = logging.getLogger()
+
+VERSION = 1  # Bump this when the snapshots or the way plates are drawn change
+EDGE_TOLERANCE = 1e-6  # How close (in mm) a vertex has to be to a cutout to be on its edge
+
+# KeyboardCase attributes that every layer depends on, set before anything is drawn
+BASE_SETTINGS = (
+    'case', 'corner_type', 'corners', 'foot_count', 'foot_hole_diameter', 'foot_hole_square', 'foot_holes',
+    'grow_x', 'grow_y', 'height', 'holes', 'kerf', 'layers', 'oversize', 'oversize_distance', 'stab_type',
+    'switch_type', 'thickness', 'usb_height', 'usb_inner_width', 'usb_layers', 'usb_offset', 'usb_outer_width',
+    'width', 'x_pad', 'x_pcb_pad', 'y_pad', 'y_pcb_pad'
+)
+
+# Problems that are only found while drawing the parts of a plate that don't depend on the keys
+BASE_ERRORS = ('invalid_hole_count', 'unknown_corner_type')
+
+
+def fingerprint(case):
+    """Return a hash of everything a KeyboardCase's plates depend on other than its keys.
+    """
+    settings = dict((name, getattr(case, name)) for name in BASE_SETTINGS)
+
+    return hashlib.sha1(json.dumps([VERSION, settings], sort_keys=True)).hexdigest()
+
+
+def cutout_bbox(cutout, margin=0):
+    """Return the bounds of a cutout in plate coordinates, where Y points the other way.
+    """
+    if cutout[0] == 'circle':
+        (x, y), radius = cutout[1], cutout[2]
+        return x - radius - margin, -y - radius - margin, x + radius + margin, -y + radius + margin
+
+    xs = [point[0] for point in cutout[1]]
+    ys = [-point[1] for point in cutout[1]]
+
+    return min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin
+
+
+def on_edge(cutout, x, y):
+    """Returns True if the plate coordinate x,y is on the edge of a cutout.
+    """
+    if cutout[0] == 'circle':
+        (center_x, center_y), radius = cutout[1], cutout[2]
+        return abs(math.hypot(x - center_x, -y - center_y) - radius) <= EDGE_TOLERANCE
+
+    points = cutout[1]
+    return any(distance_to_edge(x, -y, points[i-1], points[i]) <= EDGE_TOLERANCE for i in range(len(points)))
+
+
+def patch(plate, old_cutouts, new_cutouts):
+    """Return a copy of a plate with the cutouts that changed between two builds cut again.
+
+    `plate` was cut with `old_cutouts`, both are lists of (label, cutout) in
+    the order they were cut, and every cutout for a key shares its label.
+    Each hole that a changed cutout had a hand in is filled back in, along
+    with the holes that share a cutout with it, then every cutout for those
+    holes is cut again from `new_cutouts`.
+
+    Returns the plate and the set of labels that were cut again, or None
+    when a changed cutout reaches the outline and the plate has to be drawn
+    from scratch.
+    """
+    old_labels = set(label for label, cutout in old_cutouts)
+    new_labels = set(label for label, cutout in new_cutouts)
+    removed, added = old_labels - new_labels, new_labels - old_labels
+    plate = plate.copy()
+    if not removed and not added:
+        return plate, set()
+
+    # Cutouts closer than plate2d.subtract() looks could have joined the same hole
+    margin = plate2d.SIDE_TEST * 10
+    grid = Grid()
+    for label, cutout in old_cutouts:
+        grid.add(cutout_bbox(cutout, margin))
+
+    owners = []
+    for loop, box in zip(plate.loops, plate.boxes):
+        if plate2d.loop_area(loop) < 0:
+            owners.append(set(old_cutouts[i][0] for i in grid.query(box)))
+        else:
+            # An outline only belongs to the cutouts that one of its edges was cut along
+            found = set()
+            for x0, y0, x1, y1, bulge in plate2d.loop_edges(loop):
+                for i in grid.query(plate2d.edge_bbox(x0, y0, x1, y1, bulge)):
+                    if on_edge(old_cutouts[i][1], x0, y0) and on_edge(old_cutouts[i][1], x1, y1):
+                        found.add(old_cutouts[i][0])
+            owners.append(found)
+
+    labels = set(removed)
+    dropped = set()
+    while True:
+        more = [i for i, found in enumerate(owners) if i not in dropped and found & labels]
+        if not more:
+            break
+        for i in more:
+            labels |= owners[i]
+            dropped.add(i)
+
+    # Islands inside the holes we fill are cut again with them, but the outline can't be
+    holes = [plate.loops[i] for i in dropped if plate2d.loop_area(plate.loops[i]) < 0]
+    for i in dropped:
+        if plate2d.loop_area(plate.loops[i]) > 0 and not any(plate2d.inside([hole], *plate.loops[i][0][:2]) for hole in holes):
+            return None
+
+    recut = (labels - removed) | added
+    plate.loops = [loop for i, loop in enumerate(plate.loops) if i not in dropped]
+    plate.boxes = [box for i, box in enumerate(plate.boxes) if i not in dropped]
+    plate.cut_cutouts([cutout for label, cutout in new_cutouts if label in recut])
+
+    return plate, recut
+
+
+class Snapshots(object):
+    """The plates from the last build of each base layout, pickled into a directory.
+
+    Only the `max_snapshots` most recently saved are kept.
+    """
+    def __init__(self, directory, max_snapshots=100):
+        self.directory = directory
+        self.max_snapshots = max_snapshots
+
+    def filename(self, key):
+        return os.path.join(self.directory, '%s.pickle' % key)
+
+    def load(self, key):
+        """Return the snapshot saved for key, or None.
+        """
+        if not os.path.exists(self.filename(key)):
+            return None
+
+        try:
+            with open(self.filename(key), 'rb') as snapshot_file:
+                snapshot = cPickle.load(snapshot_file)
+        except Exception as e:
+            log.error('Could not read the snapshot %s: %s', self.filename(key), e)
+            return None
+
+        return snapshot if snapshot.get('version') == VERSION else None
+
+    def save(self, key, snapshot):
+        """Save the snapshot for key, replacing the one that was there.
+        """
+        temp_file = '%s.%d.tmp' % (self.filename(key), os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(temp_file, 'wb') as snapshot_file:
+                cPickle.dump(dict(snapshot, version=VERSION), snapshot_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file, self.filename(key))
+        except (IOError, OSError) as e:
+            log.error('Could not write the snapshot %s: %s', self.filename(key), e)
+            return
+
+        self.prune()
+
+    def prune(self):
+        """Delete the oldest snapshots until we have max_snapshots.
+        """
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.pickle')]
+            names.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)))
+            for name in names[:-self.max_snapshots]:
+                os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            log.error('Could not prune the snapshots in %s: %s', self.directory, e)
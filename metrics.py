@@ -0,0 +1,159 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""In process counters, gauges and histograms in the Prometheus text format.
+
+Metrics are created once at import time and updated with keyword labels:
+
+    BUILDS = Counter('kb_builds_total', 'Builds finished.', ['status'])
+    BUILDS.inc(status='done')
+
+    print render()  # What kb_web serves at /metrics
+
+Every update is a dictionary lookup under a lock, so they are cheap enough
+to call from request handlers.
+"""
+import threading
+
+REGISTRY = []  # Every metric that has been created, in the order they are rendered
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric(object):
+    """Base class that keeps a value for every combination of labels.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s takes the labels %s, not %s' % (self.name, ', '.join(self.labelnames), ', '.join(sorted(labels))))
+        return tuple(unicode(labels[name]) for name in self.labelnames)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def value(self, **labels):
+        """Return the current value for a set of labels.
+        """
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        """Yield (suffix, label text, value) for every value we have.
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield '', self.label_text(key), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, _number(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only go up')
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Count observations into buckets, EG how long builds take.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', self.label_text(key, [('le', _number(bound))]), cumulative
+            yield '_sum', self.label_text(key), total
+            yield '_count', self.label_text(key), cumulative
+
+
+def render(registry=REGISTRY):
+    """Return every metric in the Prometheus text exposition format.
+    """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
@@ -0,0 +1,554 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Pure python 2D plate geometry for builds that only need DXF or SVG.
+
+`Plate` implements the small part of the cadquery Workplane API that
+KeyboardCase uses (box, fillet, center, polyline, circle, cutThruAll) so the
+same layer code draws both 3D and 2D plates. A plate is a set of closed loops
+and the material is everything inside an odd number of them.
+
+Loops are tuples of (x, y, bulge) vertices. The bulge describes the edge from
+a vertex to the next one the same way DXF does: 0 is a straight line, any
+other value is an arc that sweeps 4*atan(bulge) radians (positive is counter
+clockwise). Every loop is kept oriented so the material is on its left.
+
+Coordinates are in the same space FreeCAD exports: the workplane KeyboardCase
+draws on is the bottom face of the plate, so its Y axis points down.
+"""
+import logging
+import math
+
+log = logging.getLogger()
+
+TOLERANCE = 1e-7  # Distances shorter than this (in mm) are treated as 0
+SIDE_TEST = 1e-5  # How far off an edge we look to see which side is material
+ARC_SEGMENTS = 64  # Number of straight edges used to replace a full circle
+
+
+def bulge_arc(x0, y0, x1, y1, bulge):
+    """Return the (center_x, center_y, radius) of a bulged edge.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    length = math.hypot(dx, dy)
+    offset = (1 - bulge*bulge) / (4*bulge)
+    center_x = (x0 + x1)/2 - dy*offset
+    center_y = (y0 + y1)/2 + dx*offset
+    radius = length * (1 + bulge*bulge) / (4*abs(bulge))
+
+    return center_x, center_y, radius
+
+
+def bulge_midpoint(x0, y0, x1, y1, bulge):
+    """Return the point halfway along an edge.
+    """
+    return (x0 + x1)/2 + bulge*(y1 - y0)/2, (y0 + y1)/2 - bulge*(x1 - x0)/2
+
+
+def in_bulge(x0, y0, x1, y1, bulge, x, y):
+    """Returns True if x,y is between the chord and the arc of a bulged edge.
+    """
+    center_x, center_y, radius = bulge_arc(x0, y0, x1, y1, bulge)
+    if math.hypot(x - center_x, y - center_y) >= radius:
+        return False
+
+    side = (x1 - x0)*(y - y0) - (y1 - y0)*(x - x0)  # > 0 when left of the chord
+
+    return side < 0 if bulge > 0 else side > 0
+
+
+def tessellate(x0, y0, x1, y1, bulge):
+    """Replace a bulged edge with straight edges. Returns the vertices after x0,y0.
+    """
+    center_x, center_y, radius = bulge_arc(x0, y0, x1, y1, bulge)
+    sweep = 4 * math.atan(bulge)
+    start = math.atan2(y0 - center_y, x0 - center_x)
+    steps = max(2, int(math.ceil(abs(sweep) / (2*math.pi) * ARC_SEGMENTS)))
+    points = []
+    for i in range(1, steps):
+        angle = start + sweep*i/steps
+        points.append((center_x + radius*math.cos(angle), center_y + radius*math.sin(angle)))
+    points.append((x1, y1))
+
+    return points
+
+
+def loop_edges(loop):
+    """Yield (x0, y0, x1, y1, bulge) for every edge of a loop.
+    """
+    for i, (x0, y0, bulge) in enumerate(loop):
+        x1, y1 = loop[i+1-len(loop)][:2]
+        yield x0, y0, x1, y1, bulge
+
+
+def edge_bbox(x0, y0, x1, y1, bulge):
+    """Return the (min_x, min_y, max_x, max_y) bounds of an edge.
+    """
+    if bulge:
+        center_x, center_y, radius = bulge_arc(x0, y0, x1, y1, bulge)
+        return center_x-radius, center_y-radius, center_x+radius, center_y+radius
+
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def loop_bbox(loop):
+    """Return the (min_x, min_y, max_x, max_y) bounds of a loop.
+    """
+    boxes = [edge_bbox(*edge) for edge in loop_edges(loop)]
+
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def bbox_overlaps(a, b, margin=TOLERANCE):
+    """Returns True if two bounding boxes touch or overlap.
+    """
+    return a[0] <= b[2]+margin and b[0] <= a[2]+margin and a[1] <= b[3]+margin and b[1] <= a[3]+margin
+
+
+def bbox_inside(outer, inner):
+    """Returns True if the inner bounding box is within the outer one.
+    """
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+def inside(loops, x, y):
+    """Returns True if x,y is inside an odd number of loops.
+    """
+    result = False
+    for loop in loops:
+        for x0, y0, x1, y1, bulge in loop_edges(loop):
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0)*(x1 - x0)/(y1 - y0):
+                result = not result
+            if bulge and in_bulge(x0, y0, x1, y1, bulge, x, y):
+                result = not result
+
+    return result
+
+
+def loop_area(loop):
+    """Return the signed area of a loop, positive when it runs counter clockwise.
+    """
+    area = 0
+    for x0, y0, x1, y1, bulge in loop_edges(loop):
+        area += x0*y1 - x1*y0
+        if bulge:
+            sweep = 4 * math.atan(bulge)
+            radius = bulge_arc(x0, y0, x1, y1, bulge)[2]
+            area += radius*radius*(sweep - math.sin(sweep))  # The circular segment
+
+    return area / 2
+
+
+def reverse(loop):
+    """Return a loop that runs the other way around.
+    """
+    return tuple((loop[i+1-len(loop)][0], loop[i+1-len(loop)][1], -loop[i][2]) for i in reversed(range(len(loop))))
+
+
+def loops_with(loops, boxes, loop):
+    """Return copies of a list of loops and their bounds with another loop added.
+    """
+    return list(loops) + [loop], list(boxes) + [loop_bbox(loop)]
+
+
+def polygon(points):
+    """Return a loop for a list of points. Repeated points, including a closing point, are dropped.
+    """
+    vertices = []
+    for x, y in points:
+        if not vertices or not _same(vertices[-1], (x, y)):
+            vertices.append((float(x), float(y)))
+    if len(vertices) > 1 and _same(vertices[0], vertices[-1]):
+        vertices.pop()
+    points = vertices
+
+    return tuple((x, y, 0.0) for x, y in points)
+
+
+def circle(center_x, center_y, radius):
+    """Return a counter clockwise loop for a circle.
+    """
+    return ((center_x+radius, center_y, 1.0), (center_x-radius, center_y, 1.0))
+
+
+def rectangle(width, height, radius=0):
+    """Return a counter clockwise loop for a rectangle centered on 0,0 with optionally rounded corners.
+    """
+    x, y = width/2.0, height/2.0
+    if radius <= 0:
+        return polygon([(x, -y), (x, y), (-x, y), (-x, -y)])
+
+    bulge = math.tan(math.pi/8)  # A quarter circle
+    return (
+        (x-radius, -y, bulge), (x, -y+radius, 0.0),
+        (x, y-radius, bulge), (x-radius, y, 0.0),
+        (-x+radius, y, bulge), (-x, y-radius, 0.0),
+        (-x, -y+radius, bulge), (-x+radius, -y, 0.0),
+    )
+
+
+def _same(a, b):
+    return abs(a[0] - b[0]) <= TOLERANCE and abs(a[1] - b[1]) <= TOLERANCE
+
+
+def _intersections(a, b):
+    """Find where two straight edges touch.
+
+    Returns a list of (t, u, point) where t and u are how far along a and b the point is.
+    """
+    ax0, ay0, ax1, ay1 = a
+    bx0, by0, bx1, by1 = b
+    adx, ady = ax1 - ax0, ay1 - ay0
+    bdx, bdy = bx1 - bx0, by1 - by0
+    a_len = math.hypot(adx, ady)
+    b_len = math.hypot(bdx, bdy)
+    denominator = adx*bdy - ady*bdx
+
+    if abs(denominator) <= TOLERANCE * a_len * b_len:
+        # Parallel, only collinear edges can share points
+        if abs(adx*(by0 - ay0) - ady*(bx0 - ax0)) > TOLERANCE * a_len:
+            return []
+        points = []
+        for point in ((bx0, by0), (bx1, by1)):
+            t = ((point[0] - ax0)*adx + (point[1] - ay0)*ady) / (a_len*a_len)
+            if -TOLERANCE < t*a_len < a_len + TOLERANCE:
+                points.append((t, None, point))
+        for point in ((ax0, ay0), (ax1, ay1)):
+            u = ((point[0] - bx0)*bdx + (point[1] - by0)*bdy) / (b_len*b_len)
+            if -TOLERANCE < u*b_len < b_len + TOLERANCE:
+                points.append((None, u, point))
+        return points
+
+    t = ((bx0 - ax0)*bdy - (by0 - ay0)*bdx) / denominator
+    u = ((bx0 - ax0)*ady - (by0 - ay0)*adx) / denominator
+    if not (-TOLERANCE < t*a_len < a_len + TOLERANCE and -TOLERANCE < u*b_len < b_len + TOLERANCE):
+        return []
+
+    # Reuse an existing vertex when the edges meet at one so the loops join up exactly
+    if abs(u*b_len) <= TOLERANCE:
+        point = (bx0, by0)
+    elif abs((1-u)*b_len) <= TOLERANCE:
+        point = (bx1, by1)
+    elif abs(t*a_len) <= TOLERANCE:
+        point = (ax0, ay0)
+    elif abs((1-t)*a_len) <= TOLERANCE:
+        point = (ax1, ay1)
+    else:
+        point = (ax0 + t*adx, ay0 + t*ady)
+
+    return [(t, u, point)]
+
+
+def _split(edge, points):
+    """Split a straight edge at a list of (parameter, point). Returns the pieces as edges.
+    """
+    x0, y0, x1, y1, bulge = edge
+    length = math.hypot(x1 - x0, y1 - y0)
+    inner = sorted((t, p) for t, p in points if TOLERANCE < t*length < length - TOLERANCE)
+    vertices = [(x0, y0)] + [p for t, p in inner] + [(x1, y1)]
+    pieces = []
+    for start, end in zip(vertices, vertices[1:]):
+        if not _same(start, end):
+            pieces.append((start[0], start[1], end[0], end[1], 0.0))
+
+    return pieces
+
+
+def _sides(edge):
+    """Return points just to the left and to the right of the middle of an edge.
+    """
+    x0, y0, x1, y1, bulge = edge
+    mid_x, mid_y = bulge_midpoint(x0, y0, x1, y1, bulge)
+    # The tangent at the middle of an arc is parallel to its chord
+    length = math.hypot(x1 - x0, y1 - y0)
+    normal_x, normal_y = -(y1 - y0)/length*SIDE_TEST, (x1 - x0)/length*SIDE_TEST
+
+    return (mid_x + normal_x, mid_y + normal_y), (mid_x - normal_x, mid_y - normal_y)
+
+
+def _tessellate_loop(loop, near):
+    """Replace the bulged edges of a loop that pass near a bounding box with straight ones.
+    """
+    result = []
+    for x0, y0, x1, y1, bulge in loop_edges(loop):
+        if bulge and near(edge_bbox(x0, y0, x1, y1, bulge)):
+            result.append((x0, y0, 0.0))
+            result.extend((x, y, 0.0) for x, y in tessellate(x0, y0, x1, y1, bulge)[:-1])
+        else:
+            result.append((x0, y0, bulge))
+
+    return tuple(result)
+
+
+def _chain(edges):
+    """Join directed edges into loops.
+    """
+    def key(point):
+        return (int(round(point[0] / TOLERANCE / 10)), int(round(point[1] / TOLERANCE / 10)))
+
+    starts = {}
+    for edge in edges:
+        starts.setdefault(key(edge[:2]), []).append(edge)
+
+    def pop_from(point):
+        x, y = key(point)
+        for candidate in ((x, y), (x-1, y), (x+1, y), (x, y-1), (x, y+1), (x-1, y-1), (x+1, y+1), (x-1, y+1), (x+1, y-1)):
+            if starts.get(candidate):
+                return starts[candidate].pop()
+
+    loops = []
+    for edge in edges:
+        if edge not in starts.get(key(edge[:2]), ()):
+            continue  # Already used by another loop
+        starts[key(edge[:2])].remove(edge)
+        loop = [edge]
+        while not _same(loop[-1][2:4], loop[0][:2]):
+            edge = pop_from(loop[-1][2:4])
+            if edge is None:
+                log.error('Could not close a 2D outline at %s,%s', *loop[-1][2:4])
+                break
+            loop.append(edge)
+        loops.append(_simplify(loop))
+
+    return [loop for loop in loops if len(loop) > 1 or (loop and loop[0][2])]
+
+
+def _simplify(edges):
+    """Turn a list of joined edges into a loop, dropping vertices between collinear straight edges.
+    """
+    loop = []
+    for i, edge in enumerate(edges):
+        prev = edges[i-1]
+        if not edge[4] and not prev[4]:
+            cross = (prev[2] - prev[0])*(edge[3] - edge[1]) - (prev[3] - prev[1])*(edge[2] - edge[0])
+            dot = (prev[2] - prev[0])*(edge[2] - edge[0]) + (prev[3] - prev[1])*(edge[3] - edge[1])
+            if abs(cross) <= TOLERANCE * math.hypot(prev[2]-prev[0], prev[3]-prev[1]) * math.hypot(edge[2]-edge[0], edge[3]-edge[1]) and dot > 0:
+                continue
+        loop.append((edge[0], edge[1], edge[4]))
+
+    if not loop and edges:  # Every edge was collinear, which can only happen for a degenerate loop
+        return ()
+
+    return tuple(loop)
+
+
+def subtract(loops, cutter, boxes=None):
+    """Remove the cutter loops from the material loops.
+
+    Only the loops whose bounds overlap the cutter are touched, so cutting a
+    hole into a plate with hundreds of holes in it stays cheap. `boxes` are
+    the bounds of the material loops, if they are already known.
+
+    Returns the remaining loops and their bounds.
+    """
+    if boxes is None:
+        boxes = [loop_bbox(loop) for loop in loops]
+    cutter_bbox = loop_bbox(cutter[0])
+    for loop in cutter[1:]:
+        box = loop_bbox(loop)
+        cutter_bbox = (min(cutter_bbox[0], box[0]), min(cutter_bbox[1], box[1]),
+                       max(cutter_bbox[2], box[2]), max(cutter_bbox[3], box[3]))
+    margin = SIDE_TEST * 10
+
+    def near(box):
+        return bbox_overlaps(box, cutter_bbox, margin)
+
+    affected = []
+    untouched = []
+    untouched_boxes = []
+    for loop, box in zip(loops, boxes):
+        if near(box):
+            affected.append(loop)
+        else:
+            untouched.append(loop)
+            untouched_boxes.append(box)
+    if not affected:
+        return list(loops), list(boxes)
+
+    # Arcs that could touch the other shape are replaced by straight edges,
+    # and edges far from the cutter are kept as they are.
+    affected = [_tessellate_loop(loop, near) for loop in affected]
+    kept = []
+    material = []
+    for loop in affected:
+        for edge in loop_edges(loop):
+            if near(edge_bbox(*edge)):
+                material.append(edge)
+            else:
+                kept.append(edge)
+    if not material and len(cutter) == 1:
+        # The cutter does not touch the outline so it is either a new hole or misses the plate
+        if inside(affected, *cutter[0][0][:2]):
+            hole = cutter[0] if loop_area(cutter[0]) < 0 else reverse(cutter[0])
+            return loops_with(loops, boxes, hole)
+        return list(loops), list(boxes)
+
+    material_boxes = [edge_bbox(*edge) for edge in material]
+    cutter = [_tessellate_loop(loop, lambda box: any(bbox_overlaps(box, b) for b in material_boxes)) for loop in cutter]
+    cutting = [edge for loop in cutter for edge in loop_edges(loop)]
+
+    # Split every edge where it touches an edge of the other shape
+    material_splits = [[] for edge in material]
+    cutting_splits = [[] for edge in cutting]
+    for i, a in enumerate(material):
+        if a[4]:
+            continue
+        for j, b in enumerate(cutting):
+            if b[4] or not bbox_overlaps(material_boxes[i], edge_bbox(*b)):
+                continue
+            for t, u, point in _intersections(a[:4], b[:4]):
+                if t is not None:
+                    material_splits[i].append((t, point))
+                if u is not None:
+                    cutting_splits[j].append((u, point))
+
+    # The material is always on the left of its edges, so a material edge
+    # stays unless the cutter is on its left. A cutter edge becomes part of
+    # the outline when the material is on exactly one side of it.
+    for edge, splits in zip(material, material_splits):
+        for piece in (_split(edge, splits) if splits else [edge]):
+            left = _sides(piece)[0]
+            if not inside(cutter, *left):
+                kept.append(piece)
+
+    for edge, splits in zip(cutting, cutting_splits):
+        for piece in (_split(edge, splits) if splits else [edge]):
+            left, right = _sides(piece)
+            left = inside(affected, *left) and not inside(cutter, *left)
+            right = inside(affected, *right) and not inside(cutter, *right)
+            if left and not right:
+                kept.append(piece)
+            elif right and not left:
+                kept.append((piece[2], piece[3], piece[0], piece[1], -piece[4]))
+
+    # Edges shared by the material and the cutter show up twice
+    unique = []
+    seen = set()
+    for edge in kept:
+        key = tuple(int(round(value / TOLERANCE / 10)) for value in edge[:4]) + (round(edge[4], 6),)
+        if key not in seen:
+            seen.add(key)
+            unique.append(edge)
+
+    result = _chain(unique)
+
+    return untouched + result, untouched_boxes + [loop_bbox(loop) for loop in result]
+
+
+def group_wires(wires):
+    """Group wires into cutters the way cadquery does.
+
+    The first remaining wire is an outer wire and every wire that fits inside
+    its bounds becomes a hole in it.
+    """
+    groups = []
+    remaining = list(wires)
+    while remaining:
+        outer = remaining.pop(0)
+        outer_bbox = loop_bbox(outer)
+        group = [outer]
+        for wire in list(remaining):
+            if bbox_inside(outer_bbox, loop_bbox(wire)):
+                group.append(wire)
+                remaining.remove(wire)
+        groups.append(group)
+
+    return groups
+
+
+class Plate(object):
+    """A flat plate that can be drawn on with the same calls as a cadquery workplane.
+    """
+    def __init__(self, width, height, thickness=0):
+        self.width = float(width)
+        self.height = float(height)
+        self.thickness = thickness
+        self.loops = [rectangle(self.width, self.height)]
+        self.boxes = [loop_bbox(loop) for loop in self.loops]
+        self.pending = []
+        self.position = (0.0, 0.0)
+
+    def copy(self):
+        """Return an independent copy of this plate.
+        """
+        plate = Plate(self.width, self.height, self.thickness)
+        plate.loops = list(self.loops)
+        plate.boxes = list(self.boxes)
+        plate.pending = list(self.pending)
+        plate.position = self.position
+
+        return plate
+
+    def edges(self, selector=None):
+        return self
+
+    def faces(self, selector=None):
+        return self
+
+    def workplane(self):
+        return self
+
+    def fillet(self, radius):
+        """Round the corners of the plate.
+        """
+        self.loops = [rectangle(self.width, self.height, radius)]
+        self.boxes = [loop_bbox(loop) for loop in self.loops]
+
+        return self
+
+    def center(self, x, y):
+        self.position = (self.position[0] + x, self.position[1] + y)
+
+        return self
+
+    def point(self, x, y):
+        """Convert a point relative to the current position to plate coordinates.
+        """
+        return self.position[0] + x, -(self.position[1] + y)
+
+    def polyline(self, points):
+        self.pending.append(polygon([self.point(x, y) for x, y in points]))
+
+        return self
+
+    def circle(self, radius):
+        x, y = self.point(0, 0)
+        self.pending.append(circle(x, y, radius))
+
+        return self
+
+    def cutThruAll(self):
+        """Cut all of the pending wires, wires within another wire are islands.
+        """
+        for group in group_wires(self.pending):
+            self.loops, self.boxes = subtract(self.loops, group, self.boxes)
+        self.pending = []
+
+        return self
+
+    def cut_cutouts(self, cutouts):
+        """Cut a list of ('polyline', points) and ('circle', center, radius) cutouts relative to the center of the plate.
+        """
+        for cutout in cutouts:
+            if cutout[0] == 'circle':
+                (x, y), radius = cutout[1:]
+                cutter = circle(x, -y, radius)
+            else:
+                cutter = polygon([(x, -y) for x, y in cutout[1]])
+            self.loops, self.boxes = subtract(self.loops, [cutter], self.boxes)
+
+        return self
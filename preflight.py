@@ -0,0 +1,230 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Find problems with a layout before any plates are drawn.
+
+Every cutout in the switch layer is placed from the parsed layout and
+indexed in a grid of KEY_UNIT sized cells, so each cutout is only tested
+against its neighbours. Cutouts that overlap or touch a cutout for something
+else (another key, a screw hole), or that run past the edge of the plate,
+are reported:
+
+    problems = preflight.check(case)
+    # [{'type': 'overlapping_keys', 'message': '...', 'x': 104.8, 'y': 28.6}]
+
+Positions are in mm from the top left of the plate.
+"""
+import math
+
+from profiles import KEY_UNIT
+
+TOLERANCE = 1e-6  # Cutouts closer than this (in mm) are touching
+
+
+def bbox(cutout):
+    """Return the (min_x, min_y, max_x, max_y) bounds of a cutout.
+    """
+    if cutout[0] == 'circle':
+        (x, y), radius = cutout[1], cutout[2]
+        return x - radius, y - radius, x + radius, y + radius
+
+    xs = [point[0] for point in cutout[1]]
+    ys = [point[1] for point in cutout[1]]
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def edges(points):
+    """Yield every edge of a closed polygon, whether or not the last point repeats the first.
+    """
+    for i in range(len(points)):
+        yield points[i-1], points[i]
+
+
+def inside(points, x, y):
+    """Returns True if x,y is inside a polygon.
+    """
+    result = False
+    for (x0, y0), (x1, y1) in edges(points):
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0)*(x1 - x0)/(y1 - y0):
+            result = not result
+
+    return result
+
+
+def distance_to_edge(x, y, start, end):
+    """Return the distance from x,y to the closest point on an edge.
+    """
+    (x0, y0), (x1, y1) = start, end
+    dx, dy = x1 - x0, y1 - y0
+    length = dx*dx + dy*dy
+    t = 0 if length == 0 else max(0, min(1, ((x - x0)*dx + (y - y0)*dy) / length))
+
+    return math.hypot(x - x0 - t*dx, y - y0 - t*dy)
+
+
+def edges_touch(a0, a1, b0, b1):
+    """Returns True if two edges cross or come within TOLERANCE of each other.
+    """
+    def side(p, q, r):
+        return (q[0] - p[0])*(r[1] - p[1]) - (q[1] - p[1])*(r[0] - p[0])
+
+    d1, d2 = side(b0, b1, a0), side(b0, b1, a1)
+    d3, d4 = side(a0, a1, b0), side(a0, a1, b1)
+    if ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0)) and 0 not in (d1, d2, d3, d4):
+        return True
+
+    return min(distance_to_edge(a0[0], a0[1], b0, b1), distance_to_edge(a1[0], a1[1], b0, b1),
+               distance_to_edge(b0[0], b0[1], a0, a1), distance_to_edge(b1[0], b1[1], a0, a1)) <= TOLERANCE
+
+
+def collide(a, b):
+    """Returns True if two cutouts overlap or touch.
+    """
+    if a[0] == 'circle' and b[0] == 'circle':
+        (ax, ay), (bx, by) = a[1], b[1]
+        return math.hypot(ax - bx, ay - by) <= a[2] + b[2] + TOLERANCE
+
+    if b[0] == 'circle':
+        a, b = b, a
+    if a[0] == 'circle':
+        (x, y), radius = a[1], a[2]
+        return inside(b[1], x, y) or any(distance_to_edge(x, y, start, end) <= radius + TOLERANCE for start, end in edges(b[1]))
+
+    if inside(b[1], *a[1][0]) or inside(a[1], *b[1][0]):
+        return True
+    a_box, b_box = bbox(a), bbox(b)
+    b_edges = [edge for edge in edges(b[1]) if
+               min(edge[0][0], edge[1][0]) <= a_box[2] + TOLERANCE and max(edge[0][0], edge[1][0]) >= a_box[0] - TOLERANCE and
+               min(edge[0][1], edge[1][1]) <= a_box[3] + TOLERANCE and max(edge[0][1], edge[1][1]) >= a_box[1] - TOLERANCE]
+
+    return any(edges_touch(a0, a1, b0, b1) for a0, a1 in edges(a[1]) for b0, b1 in b_edges)
+
+
+class Grid(object):
+    """Find the cutouts whose bounds overlap, by sorting them into square cells.
+    """
+    def __init__(self, size=KEY_UNIT):
+        self.size = size
+        self.cells = {}
+        self.boxes = []
+
+    def cells_for(self, box):
+        for i in range(int(math.floor(box[0] / self.size)), int(math.floor(box[2] / self.size)) + 1):
+            for j in range(int(math.floor(box[1] / self.size)), int(math.floor(box[3] / self.size)) + 1):
+                yield i, j
+
+    def add(self, box):
+        """Add a bounding box and return its index.
+        """
+        index = len(self.boxes)
+        self.boxes.append(box)
+        for cell in self.cells_for(box):
+            self.cells.setdefault(cell, []).append(index)
+
+        return index
+
+    def query(self, box):
+        """Return the indexes of the boxes that overlap box, in the order they were added.
+        """
+        found = set()
+        for cell in self.cells_for(box):
+            for index in self.cells.get(cell, ()):
+                other = self.boxes[index]
+                if other[0] <= box[2] + TOLERANCE and box[0] <= other[2] + TOLERANCE and \
+                        other[1] <= box[3] + TOLERANCE and box[1] <= other[3] + TOLERANCE:
+                    found.add(index)
+
+        return sorted(found)
+
+    def pairs(self):
+        """Yield each pair of indexes whose bounding boxes overlap, once.
+        """
+        seen = set()
+        for members in self.cells.values():
+            for n, a in enumerate(members):
+                for b in members[n+1:]:
+                    pair = (a, b) if a < b else (b, a)
+                    if pair in seen:
+                        continue
+                    seen.add(pair)
+                    box_a, box_b = self.boxes[a], self.boxes[b]
+                    if box_a[0] <= box_b[2] + TOLERANCE and box_b[0] <= box_a[2] + TOLERANCE and \
+                            box_a[1] <= box_b[3] + TOLERANCE and box_b[1] <= box_a[3] + TOLERANCE:
+                        yield pair
+
+
+def describe(kind, key, names):
+    if key is None:
+        return 'screw hole' if kind == 'mount_hole' else 'hole'
+
+    return '%s for key %s' % (kind, names[id(key)])
+
+
+def check(case):
+    """Return a list of problems with the cutouts in a KeyboardCase's switch layer.
+
+    Each problem is a dict with a `type` (overlapping_keys,
+    hole_hits_switch, overlapping_holes or out_of_bounds), a `message` and
+    the `x`, `y` where it is.
+    """
+    with case.timer('preflight'):
+        names = {}
+        for row, keys in enumerate(case.layout):
+            for column, key in enumerate(keys):
+                names[id(key)] = '%d in row %d' % (column + 1, row + 1)
+
+        cutouts = case.switch_cutouts()
+        half_width, half_height = case.width/2 + case.kerf, case.height/2 + case.kerf
+        problems = []
+
+        def problem(kind, message, box):
+            problems.append({
+                'type': kind,
+                'message': message,
+                'x': round((box[0] + box[2])/2 + case.width/2, 2),
+                'y': round((box[1] + box[3])/2 + case.height/2, 2)
+            })
+
+        grid = Grid()
+        for kind, key, cutout in cutouts:
+            box = bbox(cutout)
+            grid.add(box)
+            if box[0] < -half_width - TOLERANCE or box[1] < -half_height - TOLERANCE or \
+                    box[2] > half_width + TOLERANCE or box[3] > half_height + TOLERANCE:
+                problem('out_of_bounds', 'The %s goes past the edge of the plate' % describe(kind, key, names), box)
+
+        for a, b in sorted(grid.pairs()):
+            kind_a, key_a, cutout_a = cutouts[a]
+            kind_b, key_b, cutout_b = cutouts[b]
+            if key_a is not None and key_a is key_b:
+                continue  # A key's own switch and stabilizer cutouts are expected to overlap
+            if kind_a == kind_b == 'mount_hole':
+                continue  # The case design decides these, EG the poker screw holes open into the edge slots
+            if not collide(cutout_a, cutout_b):
+                continue
+
+            if key_a is not None and key_b is not None:
+                kind = 'overlapping_keys'
+            elif key_a is not None or key_b is not None:
+                kind = 'hole_hits_switch'
+            else:
+                kind = 'overlapping_holes'
+            box = (max(grid.boxes[a][0], grid.boxes[b][0]), max(grid.boxes[a][1], grid.boxes[b][1]),
+                   min(grid.boxes[a][2], grid.boxes[b][2]), min(grid.boxes[a][3], grid.boxes[b][3]))
+            problem(kind, 'The %s overlaps the %s' % (describe(kind_a, key_a, names), describe(kind_b, key_b, names)), box)
+
+    return problems
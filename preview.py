@@ -0,0 +1,105 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Draw a quick 2D preview of every layer for the web UI.
+
+The outline of each layer is drawn with plate2d, and the cutouts in the
+switch based layers are placed from the parsed layout without being cut, so
+a preview takes milliseconds where a build can take seconds:
+
+    {'width': 285.75, 'height': 95.25, 'layers': [
+        {'name': 'switch',
+         'outline': [[x0, y0, x1, y1, ...], [x, y, radius], ...],
+         'cutouts': {'switch': [...], 'stab': [...], 'hole': [...], 'usb': [...]}}
+    ]}
+
+Positions are in mm from the top left of the plate with Y pointing down,
+rounded to 0.01mm. Polygons are flat lists of x, y pairs and circles are
+[x, y, radius].
+"""
+import math
+
+from builder import SHAPE_LAYERS, SWITCH_LAYERS
+from plate2d import tessellate
+
+PRECISION = 2  # Decimal places to round to, 0.01mm is finer than any laser can cut
+
+
+def outline_shape(loop, width, height):
+    """Return a plate2d loop as a polygon or circle in preview coordinates.
+    """
+    if len(loop) == 2 and abs(loop[0][2]) == abs(loop[1][2]) == 1.0:
+        (x0, y0, bulge), (x1, y1, bulge) = loop
+        return [round((x0 + x1)/2 + width/2, PRECISION), round(height/2 - (y0 + y1)/2, PRECISION), round(math.hypot(x1 - x0, y1 - y0)/2, PRECISION)]
+
+    shape = []
+    for i, (x0, y0, bulge) in enumerate(loop):
+        points = [(x0, y0)]
+        if bulge:
+            x1, y1 = loop[i+1-len(loop)][:2]
+            points += tessellate(x0, y0, x1, y1, bulge)[:-1]
+        for x, y in points:
+            shape += [round(x + width/2, PRECISION), round(height/2 - y, PRECISION)]
+
+    return shape
+
+
+def cutout_shape(cutout, width, height):
+    """Return a cutout from KeyboardCase.layer_cutouts() as a polygon or circle in preview coordinates.
+    """
+    if cutout[0] == 'circle':
+        (x, y), radius = cutout[1], cutout[2]
+        return [round(x + width/2, PRECISION), round(y + height/2, PRECISION), round(radius, PRECISION)]
+
+    shape = []
+    for x, y in cutout[1]:
+        shape += [round(x + width/2, PRECISION), round(y + height/2, PRECISION)]
+
+    return shape
+
+
+def draw(case):
+    """Return the preview of every layer of a KeyboardCase.
+
+    The case has to be flat (only exporting 2D formats) so the outlines are
+    drawn with plate2d.
+    """
+    if not case.flat:
+        raise ValueError('Previews can only be drawn for 2D builds')
+
+    with case.timer('preview'):
+        layers = []
+        for layer in SHAPE_LAYERS + SWITCH_LAYERS:
+            if layer not in case.layers:
+                continue
+
+            cutouts = {}
+            if layer in SWITCH_LAYERS:
+                # The base plate already has the screw holes cut into it
+                plate = case.init_plate(oversize=case.oversize_distance if layer in case.oversize else 0)
+                for kind, key, cutout in case.layer_cutouts(layer):
+                    if kind != 'mount_hole':
+                        cutouts.setdefault(kind, []).append(cutout_shape(cutout, case.width, case.height))
+            else:
+                plate = case.create_layer(layer)
+
+            layers.append({
+                'name': layer,
+                'outline': [outline_shape(loop, case.width, case.height) for loop in plate.loops],
+                'cutouts': cutouts
+            })
+
+    return {'width': case.width, 'height': case.height, 'layers': layers}
@@ -0,0 +1,567 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Switch and stabilizer cutout profiles.
+
+A profile is the set of polygons that make up the cutout for a single key,
+centered on 0,0. Profiles only depend on a handful of key properties so a
+typical board only has a few distinct profiles. They are cached in `PROFILES`
+and shared between every layer and every build in the process, including
+the kb_web request threads.
+"""
+import threading
+from collections import namedtuple, OrderedDict
+from multiprocessing.util import register_after_fork
+
+import transforms
+
+
+# Constants
+KEY_UNIT = 19.05  # How many MM wide a 1u key is
+STABILIZERS = {
+    # size: (width_between_center, switch_offset)
+    2: (11.95, 0),
+    3: (19.05, 0),
+    4: (28.575, 0),
+    4.5: (34.671, 0),
+    5.5: (42.8625, 0),
+    6: (47.625, 9.525),
+    6.25: (50, 0),
+    6.5: (52.38, 0),
+    7: (57.15, 0),
+    8: (66.675, 0),
+    9: (66.675, 0),
+    10: (66.675, 0)
+}
+
+# offset: How far the switch is moved from the center of the key/stabilizer
+# switch: The switch cutout polygon, relative to the switch center
+# stabs: The stabilizer cutout polygons, relative to the key center
+# errors: Problems encountered while drawing the profile
+Profile = namedtuple('Profile', ['offset', 'switch', 'stabs', 'errors'])
+
+
+class ProfileCache(object):
+    """A bounded LRU cache of profiles that counts its hits and misses.
+
+    It is safe to share between threads. Profiles are drawn outside the
+    lock, so two threads that miss on the same key at once both draw it.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.profiles = OrderedDict()
+        self.lock = threading.Lock()
+        register_after_fork(self, ProfileCache.reset_lock)
+
+    def reset_lock(self):
+        # A worker forked while another thread held the lock would never see it released
+        self.lock = threading.Lock()
+
+    def get(self, switch_type, stab_type, width, height, kerf, layer,
+            rotate_key=None, rotate_stab=None, center_offset=False,
+            grow_x=0, grow_y=0):
+        """Return the profile for a key, drawing it only if we have not seen it before.
+        """
+        key = (switch_type, stab_type, width, height, kerf, layer, rotate_key,
+               rotate_stab, center_offset, grow_x, grow_y)
+        with self.lock:
+            profile = self.profiles.pop(key, None)
+            if profile is not None:
+                self.hits += 1
+                self.profiles[key] = profile
+                return profile
+            self.misses += 1
+
+        profile = draw_profile(*key)
+        with self.lock:
+            self.profiles.pop(key, None)
+            if len(self.profiles) >= self.size:
+                self.profiles.popitem(last=False)
+            self.profiles[key] = profile
+
+        return profile
+
+    def clear(self):
+        """Forget every cached profile and reset the counters.
+        """
+        with self.lock:
+            self.profiles.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the cache counters as a dictionary.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'profiles': len(self.profiles)}
+
+
+PROFILES = ProfileCache()
+
+
+def rotate_points(points, degrees, rotate_point):
+    """Rotate a sequence of points.
+
+    points: the points to rotate
+
+    degrees: the number of degrees to rotate
+
+    rotate_point: the coordinate to rotate around
+    """
+    return transforms.transform(transforms.rotation(degrees, rotate_point), points)
+
+
+def _orientation(rotate, degrees):
+    """Return the matrix for a cutout that is rotated 90 degrees for vertical keys and then by `degrees`.
+    """
+    matrix = transforms.rotation(90) if rotate else transforms.IDENTITY
+    if degrees:
+        matrix = transforms.compose(transforms.rotation(degrees), matrix)
+
+    return matrix
+
+
+def draw_profile(switch_type, stab_type, width, height, kerf, layer,
+                 rotate_key=None, rotate_stab=None, center_offset=False,
+                 grow_x=0, grow_y=0):
+    """Draw the cutout profile for a key. Use `PROFILES.get()` instead of calling this directly.
+
+    kerf: Half of the kerf, as stored on KeyboardCase
+
+    layer: The layer being cut, `top` and `reinforcing` have larger cutouts
+
+    rotate_key/rotate_stab: Degrees to rotate the switch/stabilizer cutout
+
+    center_offset: How far the switch is offset within the stabilizer, False to use the default
+    """
+    # Vertical keys are rotated 90 degrees
+    rotate = height > width
+    points = []
+    stabs = []
+    errors = []
+
+    # Standard locations with no offset
+    mx_height = 7 - kerf
+    mx_width = 7 - kerf
+    alps_height = 6.4 - kerf
+    alps_width = 7.8 - kerf
+    wing_inside = 2.9 + kerf
+    wing_outside = 6 - kerf
+    # FIXME: Use more descriptive names here
+    mx_stab_inside_y = 4.75 - kerf
+    mx_stab_inside_x = 8.575 + kerf
+    stab_cherry_top_x = 5.5 - kerf
+    stab_4 = 10.3 + kerf
+    stab_5 = 6.5 - kerf
+    stab_6 = 13.6 - kerf
+    mx_stab_outside_x = 15.225 - kerf
+    stab_y_wire = 2.3 - kerf
+    stab_bottom_y_wire = stab_y_wire - kerf
+    stab_9 = 16.1 - kerf
+    stab_cherry_wing_bottom_x = 0.5 - kerf
+    stab_cherry_bottom_x = 6.75 - kerf
+    stab_12 = 7.75 - kerf
+    stab_13 = 6 - kerf
+    stab_cherry_bottom_wing_bottom_y = 8 - kerf
+    stab_cherry_half_width = 3.325 - kerf
+    stab_cherry_bottom_wing_half_width = 1.65 - kerf
+    stab_cherry_outside_x = 4.2 - kerf
+    alps_stab_top_y = 4 + kerf
+    alps_stab_bottom_y = 9 - kerf
+    alps_stab_inside_x = (16.7 if width == 2.75 else 12.7) + kerf
+    alps_stab_ouside_x = alps_stab_inside_x + 2.7 - kerf*2
+
+    if layer == 'top':
+        # Cut out openings the size of keycaps
+        switch_type = 'mx'
+        stab_type = 'cherry'
+        if height > 1:
+            mx_width = (((KEY_UNIT/2) * height) + 0.5) - kerf
+        else:
+            mx_width = (((KEY_UNIT/2) * width) + 0.5) - kerf
+        mx_height = ((KEY_UNIT/2) + 0.5) - kerf
+    elif layer == 'reinforcing':
+        offset = 1
+        mx_height += offset
+        mx_width += offset
+        alps_height += offset
+        alps_width += offset
+        wing_inside += offset
+        wing_outside += offset
+        mx_stab_inside_x += offset
+        stab_cherry_top_x += 2.5 if offset < 2.5 else offset
+        stab_y_wire = mx_stab_inside_y = stab_cherry_top_x
+        stab_4 += offset
+        stab_5 += offset
+        stab_6 += offset
+        mx_stab_outside_x += offset
+        stab_9 += offset
+        stab_cherry_bottom_x += 4.28 - kerf if offset < 4.28 else offset
+        stab_cherry_wing_bottom_x = stab_bottom_y_wire = stab_cherry_bottom_wing_bottom_y = stab_13 = stab_12 = stab_cherry_bottom_x
+        stab_cherry_half_width += offset
+        stab_cherry_bottom_wing_half_width += offset
+        stab_cherry_outside_x += offset
+        alps_stab_top_y -= offset
+        alps_stab_bottom_y += offset
+        alps_stab_inside_x -= offset
+        alps_stab_ouside_x += offset
+
+    # Figure out our stabs now in case the switch itself is offset.
+    length = width
+    if rotate:
+        length = height
+
+    if length >= 2:
+        x = STABILIZERS[length][0] if length in STABILIZERS else STABILIZERS[2][0]
+        if not center_offset:
+            center_offset = STABILIZERS[length][1] if length in STABILIZERS else 0
+
+    if not center_offset > 0:
+        center_offset = 0
+
+    if switch_type == 'mx':
+        points = [
+            (mx_width+grow_x,-mx_height-grow_y),
+            (mx_width+grow_x,mx_height+grow_y),
+            (-mx_width-grow_x,mx_height+grow_y),
+            (-mx_width-grow_x,-mx_height-grow_y),
+            (mx_width+grow_x,-mx_height-grow_y)
+        ]
+    elif switch_type == 'alpsmx':
+        points = [
+            (mx_width,-mx_height),
+            (mx_width,-alps_height),
+            (alps_width,-alps_height),
+            (alps_width,alps_height),
+            (mx_width,alps_height),
+            (mx_width,mx_height),
+            (-mx_width,mx_height),
+            (-mx_width,alps_height),
+            (-alps_width,alps_height),
+            (-alps_width,-alps_height),
+            (-mx_width,-alps_height),
+            (-mx_width,-mx_height),
+            (mx_width,-mx_height)
+        ]
+    elif switch_type == 'mx-open':
+        points = [
+            (mx_width,-mx_height),
+            (mx_width,-wing_outside),
+            (alps_width,-wing_outside),
+            (alps_width,-wing_inside),
+            (mx_width,-wing_inside),
+            (mx_width,wing_inside),
+            (alps_width,wing_inside),
+            (alps_width,wing_outside),
+            (mx_width,wing_outside),
+            (mx_width,mx_height),
+            (-mx_width,mx_height),
+            (-mx_width,wing_outside),
+            (-alps_width,wing_outside),
+            (-alps_width,wing_inside),
+            (-mx_width,wing_inside),
+            (-mx_width,-wing_inside),
+            (-alps_width,-wing_inside),
+            (-alps_width,-wing_outside),
+            (-mx_width,-wing_outside),
+            (-mx_width,-mx_height),
+            (mx_width,-mx_height)
+        ]
+    elif switch_type == 'mx-open-rotatable':
+        points = [
+            (mx_width,-mx_height),
+            (mx_width,-wing_outside),
+            (alps_width,-wing_outside),
+            (alps_width,-wing_inside),
+            (mx_width,-wing_inside),
+            (mx_width,wing_inside),
+            (alps_width,wing_inside),
+            (alps_width,wing_outside),
+            (mx_width,wing_outside),
+            (mx_width,mx_height),
+            (wing_outside,mx_height),
+            (wing_outside,alps_width),
+            (wing_inside,alps_width),
+            (wing_inside,mx_height),
+            (-wing_inside,mx_height),
+            (-wing_inside,alps_width),
+            (-wing_outside,alps_width),
+            (-wing_outside,mx_height),
+            (-mx_width,mx_height),
+            (-mx_width,wing_outside),
+            (-alps_width,wing_outside),
+            (-alps_width,wing_inside),
+            (-mx_width,wing_inside),
+            (-mx_width,-wing_inside),
+            (-alps_width,-wing_inside),
+            (-alps_width,-wing_outside),
+            (-mx_width,-wing_outside),
+            (-mx_width,-mx_height),
+            (-wing_outside,-mx_height),
+            (-wing_outside,-alps_width),
+            (-wing_inside,-alps_width),
+            (-wing_inside,-mx_height),
+            (wing_inside,-mx_height),
+            (wing_inside,-alps_width),
+            (wing_outside,-alps_width),
+            (wing_outside,-mx_height),
+            (mx_width,-mx_height)
+        ]
+    elif switch_type == 'alps':
+        points = [
+            (alps_width,-alps_height),
+            (alps_width,alps_height),
+            (-alps_width,alps_height),
+            (-alps_width,-alps_height),
+            (alps_width,-alps_height),
+        ]
+
+    switch = transforms.outline(transforms.transform(_orientation(rotate, rotate_key), points))
+
+    # Cut stabilizers. We have different sections for 2U vs other sizes
+    # because cherry 2U stabs are shaped differently from larger stabs.
+    # This should be refactored for better readability.
+    if layer == 'top':
+        # Don't cut stabs on top
+        return Profile(center_offset, switch, (), tuple(errors))
+
+    if (width >= 2 and width < 3) or (rotate and height >= 2 and height < 3):
+        # Cut 2 unit stabilizer cutout
+        if stab_type == 'cherry-costar':
+            points = [
+                (mx_width,-mx_height),
+                (mx_width,-mx_stab_inside_y),
+                (mx_stab_inside_x,-mx_stab_inside_y),
+                (mx_stab_inside_x,-stab_cherry_top_x),
+                (stab_4,-stab_cherry_top_x),
+                (stab_4,-stab_5),
+                (stab_6,-stab_5),
+                (stab_6,-stab_cherry_top_x),
+                (mx_stab_outside_x,-stab_cherry_top_x),
+                (mx_stab_outside_x,-stab_y_wire),
+                (stab_9,-stab_y_wire),
+                (stab_9,stab_cherry_wing_bottom_x),
+                (mx_stab_outside_x,stab_cherry_wing_bottom_x),
+                (mx_stab_outside_x,stab_cherry_bottom_x),
+                (stab_6,stab_cherry_bottom_x),
+                (stab_6,stab_12),
+                (stab_4,stab_12),
+                (stab_4,stab_cherry_bottom_x),
+                (mx_stab_inside_x,stab_cherry_bottom_x),
+                (mx_stab_inside_x,stab_13),
+                (mx_width,stab_13),
+                (mx_width,mx_height),
+                (-mx_width,mx_height),
+                (-mx_width,stab_13),
+                (-mx_stab_inside_x,stab_13),
+                (-mx_stab_inside_x,stab_cherry_bottom_x),
+                (-stab_4,stab_cherry_bottom_x),
+                (-stab_4,stab_12),
+                (-stab_6,stab_12),
+                (-stab_6,stab_cherry_bottom_x),
+                (-mx_stab_outside_x,stab_cherry_bottom_x),
+                (-mx_stab_outside_x,stab_cherry_wing_bottom_x),
+                (-stab_9,stab_cherry_wing_bottom_x),
+                (-stab_9,-stab_y_wire),
+                (-mx_stab_outside_x,-stab_y_wire),
+                (-mx_stab_outside_x,-stab_cherry_top_x),
+                (-stab_6,-stab_cherry_top_x),
+                (-stab_6,-stab_5),
+                (-stab_4,-stab_5),
+                (-stab_4,-stab_cherry_top_x),
+                (-mx_stab_inside_x,-stab_cherry_top_x),
+                (-mx_stab_inside_x,-mx_stab_inside_y),
+                (-mx_width,-mx_stab_inside_y),
+                (-mx_width,-mx_height),
+                (mx_width,-mx_height)
+            ]
+            stabs.append(points)
+        elif stab_type == 'cherry':
+            points = [
+                (mx_stab_inside_x,-mx_stab_inside_y),
+                (mx_stab_inside_x,-stab_cherry_top_x),
+                (mx_stab_outside_x,-stab_cherry_top_x),
+                (mx_stab_outside_x,-stab_y_wire),
+                (stab_9,-stab_y_wire),
+                (stab_9,stab_cherry_wing_bottom_x),
+                (mx_stab_outside_x,stab_cherry_wing_bottom_x),
+                (mx_stab_outside_x,stab_cherry_bottom_x),
+                (stab_6,stab_cherry_bottom_x),
+                (stab_6,stab_cherry_bottom_wing_bottom_y),
+                (stab_4,stab_cherry_bottom_wing_bottom_y),
+                (stab_4,stab_cherry_bottom_x),
+                (mx_stab_inside_x,stab_cherry_bottom_x),
+                (mx_stab_inside_x,stab_13),
+                (-mx_stab_inside_x,stab_13),
+                (-mx_stab_inside_x,stab_cherry_bottom_x),
+                (-stab_4,stab_cherry_bottom_x),
+                (-stab_4,stab_cherry_bottom_wing_bottom_y),
+                (-stab_6,stab_cherry_bottom_wing_bottom_y),
+                (-stab_6,stab_cherry_bottom_x),
+                (-mx_stab_outside_x,stab_cherry_bottom_x),
+                (-mx_stab_outside_x,stab_cherry_wing_bottom_x),
+                (-stab_9,stab_cherry_wing_bottom_x),
+                (-stab_9,-stab_y_wire),
+                (-mx_stab_outside_x,-stab_y_wire),
+                (-mx_stab_outside_x,-stab_cherry_top_x),
+                (-mx_stab_inside_x,-stab_cherry_top_x),
+                (-mx_stab_inside_x,-mx_stab_inside_y),
+                (mx_stab_inside_x,-mx_stab_inside_y),
+            ]
+            stabs.append(points)
+        elif stab_type == 'costar':
+            points_l = [
+                (-stab_4,-stab_5),
+                (-stab_6,-stab_5),
+                (-stab_6,stab_12),
+                (-stab_4,stab_12),
+                (-stab_4,-stab_5)
+            ]
+            points_r = [
+                (stab_4,-stab_5),
+                (stab_6,-stab_5),
+                (stab_6,stab_12),
+                (stab_4,stab_12),
+                (stab_4,-stab_5)
+            ]
+            stabs.append(points_l)
+            stabs.append(points_r)
+        elif stab_type in ('alps', 'matias'):
+            points_r = [
+                (alps_stab_inside_x, alps_stab_top_y),
+                (alps_stab_ouside_x, alps_stab_top_y),
+                (alps_stab_ouside_x, alps_stab_bottom_y),
+                (alps_stab_inside_x, alps_stab_bottom_y),
+                (alps_stab_inside_x, alps_stab_top_y)
+            ]
+            points_l = [
+                (-alps_stab_inside_x, alps_stab_top_y),
+                (-alps_stab_ouside_x, alps_stab_top_y),
+                (-alps_stab_ouside_x, alps_stab_bottom_y),
+                (-alps_stab_inside_x, alps_stab_bottom_y),
+                (-alps_stab_inside_x, alps_stab_top_y)
+            ]
+
+            stabs.append(points_l)
+            stabs.append(points_r)
+        else:
+            errors.append('Unknown stab type %s! No stabilizer cut' % stab_type)
+
+    # Cut larger stabilizer cutouts
+    elif (width >= 3) or (rotate and height >= 3):
+        if stab_type == 'cherry-costar':
+            points = [
+                (x-stab_cherry_half_width,-stab_y_wire),
+                (x-stab_cherry_half_width,-stab_cherry_top_x),
+                (x-stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
+                (x-stab_cherry_bottom_wing_half_width,-stab_5),
+                (x+stab_cherry_bottom_wing_half_width,-stab_5),
+                (x+stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
+                (x+stab_cherry_half_width,-stab_cherry_top_x),
+                (x+stab_cherry_half_width,-stab_y_wire),
+                (x+stab_cherry_outside_x,-stab_y_wire),
+                (x+stab_cherry_outside_x,stab_cherry_wing_bottom_x),
+                (x+stab_cherry_half_width,stab_cherry_wing_bottom_x),
+                (x+stab_cherry_half_width,stab_cherry_bottom_x),
+                (x+stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
+                (x+stab_cherry_bottom_wing_half_width,stab_12),
+                (x-stab_cherry_bottom_wing_half_width,stab_12),
+                (x-stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
+                (x-stab_cherry_half_width,stab_cherry_bottom_x),
+                (x-stab_cherry_half_width,stab_y_wire),
+                (-x+stab_cherry_half_width,stab_y_wire),
+                (-x+stab_cherry_half_width,stab_cherry_bottom_x),
+                (-x+stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
+                (-x+stab_cherry_bottom_wing_half_width,stab_12),
+                (-x-stab_cherry_bottom_wing_half_width,stab_12),
+                (-x-stab_cherry_bottom_wing_half_width,stab_cherry_bottom_x),
+                (-x-stab_cherry_half_width,stab_cherry_bottom_x),
+                (-x-stab_cherry_half_width,stab_cherry_wing_bottom_x),
+                (-x-stab_cherry_outside_x,stab_cherry_wing_bottom_x),
+                (-x-stab_cherry_outside_x,-stab_y_wire),
+                (-x-stab_cherry_half_width,-stab_y_wire),
+                (-x-stab_cherry_half_width,-stab_cherry_top_x),
+                (-x-stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
+                (-x-stab_cherry_bottom_wing_half_width,-stab_5),
+                (-x+stab_cherry_bottom_wing_half_width,-stab_5),
+                (-x+stab_cherry_bottom_wing_half_width,-stab_cherry_top_x),
+                (-x+stab_cherry_half_width,-stab_cherry_top_x),
+                (-x+stab_cherry_half_width,-stab_y_wire),
+                (x-stab_cherry_half_width,-stab_y_wire)
+            ]
+            stabs.append(points)
+        elif stab_type == 'cherry':
+            points = [
+                (x - stab_cherry_half_width, -stab_y_wire),#1
+                (x - stab_cherry_half_width, -stab_cherry_top_x),#2
+                (x + stab_cherry_half_width, -stab_cherry_top_x),#3
+                (x + stab_cherry_half_width, -stab_y_wire),#4
+                (x + stab_cherry_outside_x, -stab_y_wire),#5
+                (x + stab_cherry_outside_x, stab_cherry_wing_bottom_x),#6
+                (x + stab_cherry_half_width, stab_cherry_wing_bottom_x),#7
+                (x + stab_cherry_half_width, stab_cherry_bottom_x),#8
+                (x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#9
+                (x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#10
+                (x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#11
+                (x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#12
+                (x - stab_cherry_half_width, stab_cherry_bottom_x),#13
+                (x - stab_cherry_half_width, stab_bottom_y_wire),#14
+                (-x + stab_cherry_half_width, stab_bottom_y_wire),#15
+                (-x + stab_cherry_half_width, stab_cherry_bottom_x),#16
+                (-x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#17
+                (-x + stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#18
+                (-x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_wing_bottom_y),#19
+                (-x - stab_cherry_bottom_wing_half_width, stab_cherry_bottom_x),#20
+                (-x - stab_cherry_half_width, stab_cherry_bottom_x),#21
+                (-x - stab_cherry_half_width, stab_cherry_wing_bottom_x),#22
+                (-x - stab_cherry_outside_x, stab_cherry_wing_bottom_x),#23
+                (-x - stab_cherry_outside_x, -stab_y_wire),#24
+                (-x - stab_cherry_half_width, -stab_y_wire),#25
+                (-x - stab_cherry_half_width, -stab_cherry_top_x),#26
+                (-x + stab_cherry_half_width, -stab_cherry_top_x),#27
+                (-x + stab_cherry_half_width, -stab_y_wire),#28
+                (x - stab_cherry_half_width, -stab_y_wire),#1
+            ]
+            stabs.append(points)
+        elif stab_type in ('costar', 'matias'):
+            points_l = [
+                (-x+stab_cherry_bottom_wing_half_width,-stab_5),
+                (-x-stab_cherry_bottom_wing_half_width,-stab_5),
+                (-x-stab_cherry_bottom_wing_half_width,stab_12),
+                (-x+stab_cherry_bottom_wing_half_width,stab_12),
+                (-x+stab_cherry_bottom_wing_half_width,-stab_5)
+            ]
+            points_r = [
+                (x-stab_cherry_bottom_wing_half_width,-stab_5),
+                (x+stab_cherry_bottom_wing_half_width,-stab_5),
+                (x+stab_cherry_bottom_wing_half_width,stab_12),
+                (x-stab_cherry_bottom_wing_half_width,stab_12),
+                (x-stab_cherry_bottom_wing_half_width,-stab_5)
+            ]
+            stabs.append(points_l)
+            stabs.append(points_r)
+        elif stab_type == 'alps':
+            # FIXME: Pull this in from your stashed patch
+            errors.append('Vintage alps stabilizers for spacebar not implemented!')
+        else:
+            errors.append('Unknown stab type %s! No stabilizer cut' % stab_type)
+
+    # Every stabilizer outline is oriented the same way, so do them all at once
+    stabs = transforms.transform_many(_orientation(rotate, rotate_stab), stabs)
+
+    return Profile(center_offset, switch, tuple(transforms.outline(points) for points in stabs), tuple(errors))
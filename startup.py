@@ -0,0 +1,92 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Import FreeCAD and friends the first time they are needed.
+
+Loading FreeCAD takes longer than building most plates, so builder doesn't
+import anything from it until a layer needs a 3D model or one of FreeCAD's
+exporters:
+
+    cadquery = startup.load('cadquery')  # None when FreeCAD isn't installed
+
+Every import is timed and the functions in HOOKS are called with the name of
+what was loaded and how many seconds it took.
+"""
+import importlib
+import logging
+import threading
+import time
+
+import config
+
+log = logging.getLogger()
+
+# Modules that can only be imported once FreeCAD is on sys.path
+FREECAD_MODULES = ('FreeCAD', 'cadquery', 'Part', 'Mesh', 'MeshPart', 'importDXF', 'importSVG')
+
+IMPORT_TIMES = {}  # Seconds each import took, keyed on module name
+_modules = {}
+_lock = threading.RLock()
+
+
+def log_import(name, seconds):
+    log.debug('Loaded %s in %.3f seconds', name, seconds)
+
+
+HOOKS = [log_import]  # Called with (name, seconds) after every timed import
+
+
+def timed(name, function, *args):
+    """Call function(*args), recording how long it took under name.
+    """
+    start = time.time()
+    try:
+        return function(*args)
+    finally:
+        seconds = time.time() - start
+        IMPORT_TIMES[name] = seconds
+        for hook in HOOKS:
+            hook(name, seconds)
+
+
+def load(name):
+    """Return a module, importing it the first time. Returns None if it can't be imported.
+    """
+    with _lock:
+        if name not in _modules:
+            if name in FREECAD_MODULES:
+                if 'freecad_path' not in IMPORT_TIMES:
+                    timed('freecad_path', config.setup_freecad_path)
+                if name != 'FreeCAD' and load('FreeCAD') is None:
+                    _modules[name] = None
+                    return None
+
+            try:
+                _modules[name] = timed(name, importlib.import_module, name)
+            except ImportError as e:
+                log.debug('Could not import %s: %s', name, e)
+                _modules[name] = None
+
+        return _modules[name]
+
+
+def preload(names=FREECAD_MODULES):
+    """Import modules ahead of time, EG before forking workers that will need them.
+    """
+    for name in names:
+        load(name)
+
+    return dict((name, IMPORT_TIMES[name]) for name in names if name in IMPORT_TIMES)
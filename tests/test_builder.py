@@ -0,0 +1,52 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import unittest
+
+from builder import KeyboardCase
+
+logging.disable(logging.CRITICAL)
+
+LAYOUT = [['Esc', '1', '2', '3'], ['Tab', 'Q', 'W', 'E']]
+
+
+def mount_holes(**kwargs):
+    """Return the screw hole and slot cutouts of a poker switch layer.
+    """
+    case = KeyboardCase(LAYOUT, 'test', case_type='poker', formats=['dxf'], **kwargs)
+    return [cutout for kind, key, cutout in case.layer_cutouts('switch') if kind == 'mount_hole']
+
+
+class MountHoleTest(unittest.TestCase):
+    def test_integer_sizes(self):
+        # Integer settings used to be halved with integer division
+        holes = mount_holes(mount_holes_size=5, kerf=0)
+        self.assertEqual(holes, mount_holes(mount_holes_size=5.0, kerf=0.0))
+
+        circles = [cutout for cutout in holes if cutout[0] == 'circle']
+        self.assertEqual(len(circles), 6)
+        self.assertTrue(all(radius == 2.5 for shape, center, radius in circles))
+
+        slots = [cutout[1] for cutout in holes if cutout[0] != 'circle']
+        self.assertEqual(len(slots), 2)
+        for points in slots:
+            ys = [y for x, y in points]
+            self.assertAlmostEqual(max(ys) - min(ys), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
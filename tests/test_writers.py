@@ -0,0 +1,117 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import math
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from plate2d import bulge_midpoint
+from writers import DXFWriter, SVGWriter
+
+try:
+    import ezdxf
+except ImportError:
+    ezdxf = None
+
+# A rounded slot and a screw hole, like the ones in a switch plate
+SLOT = [(0, 0, 0), (10, 0, 1.0), (10, 5, 0), (0, 5, 1.0)]
+HOLE = (20, 2.5, 1.5)
+
+
+def write_dxf(output):
+    with DXFWriter(output) as dxf:
+        dxf.loop(SLOT)
+        dxf.circle(*HOLE)
+        dxf.line(0, -5, 10, -5)
+        dxf.arc(5, -5, 2, 0, 90)
+
+
+def group_pairs(text):
+    lines = text.splitlines()
+    return [(int(lines[i]), lines[i+1]) for i in range(0, len(lines), 2)]
+
+
+def svg_arc_midpoint(x0, y0, radius, large, sweep, x1, y1):
+    """The midpoint of an SVG arc, found the way the SVG spec finds its center.
+    """
+    half_x, half_y = (x0 - x1)/2, (y0 - y1)/2
+    scale = math.sqrt(max(radius*radius / (half_x*half_x + half_y*half_y) - 1, 0))
+    if large == sweep:
+        scale = -scale
+    center_x, center_y = scale*half_y + (x0 + x1)/2, -scale*half_x + (y0 + y1)/2
+    start = math.atan2(y0 - center_y, x0 - center_x)
+    delta = math.atan2(y1 - center_y, x1 - center_x) - start
+    if sweep and delta < 0:
+        delta += 2*math.pi
+    elif not sweep and delta > 0:
+        delta -= 2*math.pi
+    return center_x + radius*math.cos(start + delta/2), center_y + radius*math.sin(start + delta/2)
+
+
+class DXFWriterTest(unittest.TestCase):
+    def test_complete_r12_file(self):
+        output = StringIO()
+        write_dxf(output)
+        pairs = group_pairs(output.getvalue())
+
+        self.assertEqual(pairs[:6], [(0, 'SECTION'), (2, 'HEADER'), (9, '$ACADVER'), (1, 'AC1009'), (0, 'ENDSEC'), (0, 'SECTION')])
+        self.assertEqual(pairs[-2:], [(0, 'ENDSEC'), (0, 'EOF')])
+        entities = [value for code, value in pairs if code == 0]
+        self.assertEqual(entities[3:-2], ['POLYLINE'] + ['VERTEX'] * len(SLOT) + ['SEQEND', 'CIRCLE', 'LINE', 'ARC'])
+        self.assertEqual([value for code, value in pairs if code == 42], ['1.0', '1.0'])
+
+    @unittest.skipUnless(ezdxf, 'ezdxf is not installed')
+    def test_round_trip(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'switch.dxf')
+            write_dxf(path)
+            doc = ezdxf.readfile(path)
+        finally:
+            shutil.rmtree(directory)
+
+        msp = doc.modelspace()
+        polyline, = msp.query('POLYLINE')
+        self.assertTrue(polyline.is_closed)
+        self.assertEqual([(v.dxf.location[0], v.dxf.location[1], v.dxf.bulge) for v in polyline.vertices], SLOT)
+        circle, = msp.query('CIRCLE')
+        self.assertEqual((circle.dxf.center[0], circle.dxf.center[1], circle.dxf.radius), HOLE)
+        self.assertEqual(len(msp.query('LINE')), 1)
+        self.assertEqual(len(msp.query('ARC')), 1)
+
+
+class SVGWriterTest(unittest.TestCase):
+    def test_arcs_bulge_the_same_way(self):
+        # Flipping Y for SVG also flips which way an arc turns
+        for bulge in (0.5, -0.5, 1.0, -1.0, 2.0, -2.0):
+            output = StringIO()
+            with SVGWriter(output, (0, -10, 10, 10)) as svg:
+                svg.loop([(0, 0, bulge), (10, 0, 0)])
+            arc = re.search(r'A(\S+) \S+ 0 (\d) (\d) ([-\d.]+) ([-\d.]+)', output.getvalue()).groups()
+            radius, large, sweep, x1, y1 = float(arc[0]), int(arc[1]), int(arc[2]), float(arc[3]), float(arc[4])
+
+            x, y = svg_arc_midpoint(0, 0, radius, large, sweep, x1, y1)
+            expected_x, expected_y = bulge_midpoint(0, 0, 10, 0, bulge)
+            self.assertAlmostEqual(x, expected_x, places=3)
+            self.assertAlmostEqual(y, -expected_y, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Affine transforms for cutout outlines.
+
+A matrix is a tuple of rows (a, b, c), each row gives one output coordinate
+as a*x + b*y + c. Two rows map the plane onto itself, three rows map it into
+3D space (EG, onto a FreeCAD workplane). Matrices are combined with
+`compose()` so any number of rotations and translations cost a single pass
+over the points.
+
+NumPy is used to transform whole layers at once when it is installed,
+otherwise everything falls back to plain python.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+IDENTITY = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0))
+
+
+def rotation(degrees, about=(0, 0)):
+    """Return a matrix that rotates counter clockwise around a point.
+    """
+    cos = math.cos(math.radians(degrees))
+    sin = math.sin(math.radians(degrees))
+    x0, y0 = about
+
+    return ((cos, -sin, x0 - cos*x0 + sin*y0), (sin, cos, y0 - sin*x0 - cos*y0))
+
+
+def translation(x, y):
+    """Return a matrix that moves points by x, y.
+    """
+    return ((1.0, 0.0, x), (0.0, 1.0, y))
+
+
+def compose(outer, inner):
+    """Return a matrix that applies `inner` and then `outer`.
+    """
+    (a0, b0, c0), (a1, b1, c1) = inner
+
+    return tuple((a*a0 + b*a1, a*b0 + b*b1, a*c0 + b*c1 + c) for a, b, c in outer)
+
+
+def outline(points):
+    """Return an immutable copy of an outline, a read only array when NumPy is available.
+    """
+    if numpy is None:
+        return tuple((float(x), float(y)) for x, y in points)
+
+    array = numpy.array(points, dtype=float).reshape(-1, 2)
+    array.setflags(write=False)
+
+    return array
+
+
+def transform(matrix, points):
+    """Apply a matrix to an outline, returns a list of tuples.
+    """
+    return transform_many(matrix, [points])[0]
+
+
+def transform_many(matrix, outlines, offsets=None):
+    """Move each outline by its (x, y) offset and then apply a matrix to it.
+
+    Returns a list of tuples for each outline. With NumPy all of the outlines
+    are transformed with one operation.
+    """
+    if not outlines:
+        return []
+
+    if numpy is not None:
+        lengths = [len(points) for points in outlines]
+        points = numpy.concatenate([numpy.asarray(points, dtype=float).reshape(-1, 2) for points in outlines])
+        if offsets:
+            points = points + numpy.repeat(numpy.asarray(offsets, dtype=float), lengths, axis=0)
+        matrix = numpy.asarray(matrix, dtype=float)
+        points = points.dot(matrix[:, :2].T) + matrix[:, 2]
+
+        return [map(tuple, part.tolist()) for part in numpy.split(points, numpy.cumsum(lengths)[:-1])]
+
+    transformed = []
+    for i, points in enumerate(outlines):
+        # Fold the offset into the matrix so each point is only touched once
+        rows = compose(matrix, translation(*offsets[i])) if offsets else matrix
+        if len(rows) == 2:
+            (a0, b0, c0), (a1, b1, c1) = rows
+            transformed.append([(a0*x + b0*y + c0, a1*x + b1*y + c1) for x, y in points])
+        else:
+            transformed.append([tuple(a*x + b*y + c for a, b, c in rows) for x, y in points])
+
+    return transformed
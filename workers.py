@@ -0,0 +1,342 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A pool of worker processes that run builds in the background.
+
+FreeCAD keeps global state (like the ActiveDocument) so builds can not share a
+process. Each worker is its own process and runs one job at a time. Jobs are
+tracked by id in the parent process so their status can be polled:
+
+    pool = WorkerPool(build_case)
+    pool.submit('abc123', builder_args)
+    pool.status('abc123')  # {'id': 'abc123', 'status': 'running', ...}
+
+Targets can also report progress while they run, the events are kept with
+the job until it is forgotten:
+
+    pool = WorkerPool(build_case, progress=True)  # Calls build_case(*args, progress=report)
+    events, job = pool.events('abc123', start=0, timeout=15)
+
+Whatever FreeCAD and OpenCASCADE don't give back builds up over the life of
+a worker, so a worker is replaced with a fresh process once it has run
+`max_builds` jobs or its RSS has grown past `max_rss_mb`:
+
+    pool = WorkerPool(build_case, max_builds=100, max_rss_mb=2048)
+
+A worker that dies without saying so (a segfault in OpenCASCADE, the OOM
+killer) is noticed within WORKER_CHECK_INTERVAL, the job it was running
+fails and a fresh worker takes its place.
+"""
+import Queue
+import logging
+import multiprocessing
+import resource
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+log = logging.getLogger()
+
+# The states a job goes through
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+PROGRESS = 'progress'  # Not a state, a progress event from a running job
+RECYCLE = 'recycle'  # Not a state, a worker that has exited so it can be replaced
+
+WORKER_CHECK_INTERVAL = 1  # Seconds between checks for workers that have died
+
+
+def rss_mb():
+    """Return the memory this process is using right now, or None if we can't tell.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def _worker(target, tasks, results, progress=False, max_builds=None, max_rss_mb=None):
+    """Run jobs from the tasks queue until we get None, or until it is time for a fresh process.
+    """
+    name = multiprocessing.current_process().name
+    builds = 0
+    for job_id, args in iter(tasks.get, None):
+        results.put((job_id, RUNNING, name))
+        kwargs = {'progress': lambda event: results.put((job_id, PROGRESS, event))} if progress else {}
+        try:
+            results.put((job_id, DONE, target(*args, **kwargs)))
+        except Exception as e:
+            log.error('Job %s failed:\n%s', job_id, traceback.format_exc())
+            results.put((job_id, FAILED, '%s: %s' % (e.__class__.__name__, e)))
+
+        builds += 1
+        memory = rss_mb()
+        if max_builds and builds >= max_builds:
+            results.put((name, RECYCLE, ('builds', 'ran %d builds' % builds)))
+            return
+        if max_rss_mb and memory is not None and memory > max_rss_mb:
+            results.put((name, RECYCLE, ('memory', 'is using %.1f MB after %d builds' % (memory, builds))))
+            return
+
+
+class WorkerPool(object):
+    """Run `target(*args)` for each submitted job in a pool of worker processes.
+
+    `on_done(job_id, result)` is called in the parent process when a job
+    finishes, and `on_failed(job_id, error)` when one fails. Only the
+    `max_jobs` most recent jobs are remembered. With `progress` the target is
+    also passed a `progress` function to report events with.
+
+    A worker is replaced after `max_builds` jobs, or after a job leaves it
+    using more than `max_rss_mb`, and `on_recycle(name, reason)` is called
+    with 'builds' or 'memory' when it is.
+    """
+    def __init__(self, target, processes=None, on_done=None, max_jobs=1000, on_failed=None, progress=False,
+                 max_builds=None, max_rss_mb=None, on_recycle=None):
+        self.target = target
+        self.progress = progress
+        self.max_builds = max_builds
+        self.max_rss_mb = max_rss_mb
+        self.on_recycle = on_recycle
+        self.processes = processes or multiprocessing.cpu_count()
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)  # Notified whenever a job gets an event or changes state
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        self.running = {}  # The id of the job each worker is running, by worker name
+        self.died = {}  # The exit code of each worker that died, by worker name
+        self.spawned = 0  # Worker processes started, including the ones that replaced recycled workers
+        self.recycled = 0
+        self.stopping = False
+        self.collector = None
+
+    def spawn(self):
+        """Start a worker process and return it.
+        """
+        worker = multiprocessing.Process(target=_worker, name='kb_worker_%d' % self.spawned,
+                                         args=(self.target, self.tasks, self.results, self.progress, self.max_builds, self.max_rss_mb))
+        worker.daemon = True
+        worker.start()
+        self.spawned += 1
+
+        return worker
+
+    def start(self):
+        """Start the worker processes and the thread that collects their results.
+        """
+        for i in range(self.processes):
+            self.workers.append(self.spawn())
+
+        self.collector = threading.Thread(target=self.collect, name='kb_collector')
+        self.collector.daemon = True
+        self.collector.start()
+        log.info('Started %d build workers', self.processes)
+
+        return self
+
+    def stop(self):
+        """Let the workers finish their current job and exit.
+        """
+        self.stopping = True
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def collect(self):
+        """Update the jobs as the workers report back, and replace workers that have died.
+        """
+        checked = time.time()
+        while True:
+            try:
+                job_id, status, result = self.results.get(timeout=WORKER_CHECK_INTERVAL)
+            except Queue.Empty:
+                status = None
+            if time.time() - checked >= WORKER_CHECK_INTERVAL:
+                self.check_workers()
+                checked = time.time()
+            if status is None:
+                continue
+            if status == RECYCLE:
+                self.recycle(job_id, *result)
+                continue
+            if status == RUNNING:
+                self.running[result] = job_id
+            elif status in (DONE, FAILED):
+                for name in [name for name, running_id in self.running.items() if running_id == job_id]:
+                    del self.running[name]
+            self.update(job_id, status, result)
+
+    def update(self, job_id, status, result):
+        """Record a progress event or a new status for a job, calling on_done or on_failed when it finishes.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            self.changed.notify_all()
+            if status == PROGRESS:
+                job['events'].append(result)
+                return
+            job['status'] = status
+            if status == RUNNING:
+                job['started'] = time.time()
+                return
+            job['finished'] = time.time()
+            if status == DONE:
+                job['result'] = result
+            else:
+                job['error'] = result
+
+        log.info('Job %s %s in %.2f seconds', job_id, status, job['finished'] - job['started'])
+        callback = self.on_done if status == DONE else self.on_failed
+        if callback:
+            try:
+                callback(job_id, result)
+            except Exception:
+                log.error('Callback failed for job %s:\n%s', job_id, traceback.format_exc())
+        job['event'].set()
+
+    def check_workers(self):
+        """Fail the job of any worker that died without exiting cleanly, and start a worker in its place.
+
+        Workers that exit cleanly have told us why and are replaced by recycle().
+        """
+        for i, worker in enumerate(self.workers):
+            if self.stopping or worker.is_alive() or worker.exitcode == 0:
+                continue
+            worker.join()
+            log.error('%s died with exit code %s', worker.name, worker.exitcode)
+            self.died[worker.name] = worker.exitcode
+            self.workers[i] = self.spawn()
+
+        # A job can start just before its worker dies and be heard about after, so this is checked every time
+        for name, job_id in self.running.items():
+            if name in self.died:
+                del self.running[name]
+                self.update(job_id, FAILED, 'WorkerDied: the build worker exited with code %s' % self.died[name])
+
+    def recycle(self, name, reason, message):
+        """Replace a worker that has exited because it ran too many builds or got too big.
+        """
+        log.info('Recycling %s, it %s', name, message)
+        for i, worker in enumerate(self.workers):
+            if worker.name == name and not self.stopping:
+                worker.join()
+                self.workers[i] = self.spawn()
+                break
+        self.recycled += 1
+        if self.on_recycle:
+            try:
+                self.on_recycle(name, reason)
+            except Exception:
+                log.error('Callback failed for recycling %s:\n%s', name, traceback.format_exc())
+
+    def submit(self, job_id, *args):
+        """Queue a job unless a job with that id is already queued, running or done.
+
+        Returns the status of the job.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] == FAILED:
+                job = {
+                    'id': job_id,
+                    'status': QUEUED,
+                    'submitted': time.time(),
+                    'started': None,
+                    'finished': None,
+                    'result': None,
+                    'error': None,
+                    'events': [],
+                    'event': threading.Event()
+                }
+                self.jobs.pop(job_id, None)
+                self.jobs[job_id] = job
+                self.tasks.put((job_id, args))
+                self.forget()
+
+            return self.public(job)
+
+    def forget(self):
+        """Drop the oldest finished jobs when we are tracking too many.
+        """
+        for job_id in list(self.jobs):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[job_id]['status'] in (DONE, FAILED):
+                del self.jobs[job_id]
+
+    def public(self, job):
+        return dict((key, value) for key, value in job.items() if key not in ('event', 'events'))
+
+    def status(self, job_id):
+        """Return the status of a job, or None if we don't know about it.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return self.public(job) if job else None
+
+    def wait(self, job_id, timeout=None):
+        """Block until a job has finished and return its status.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job['event'].wait(timeout)
+
+        return self.status(job_id) or self.public(job)
+
+    def events(self, job_id, start=0, timeout=None):
+        """Wait until a job has more than `start` progress events or has finished.
+
+        Returns the new events and the status of the job, or None if we don't
+        know about it. The events may be empty if the timeout ran out first.
+        """
+        with self.changed:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if len(job['events']) <= start and job['status'] not in (DONE, FAILED):
+                self.changed.wait(timeout)
+
+            return job['events'][start:], self.public(job)
+
+    def queued(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job['status'] == QUEUED)
+
+    def counts(self):
+        """Return how many of the remembered jobs are in each state.
+        """
+        counts = dict((status, 0) for status in (QUEUED, RUNNING, DONE, FAILED))
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job['status']] += 1
+
+        return counts
@@ -0,0 +1,277 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Streaming DXF, SVG and binary STL writers.
+
+The writers take a filename or an open file object and write every entity as
+soon as it is added, so nothing but the entity being written is kept in memory.
+Outlines are drawn with `loop()`, which takes the same (x, y, bulge) vertices
+plate2d uses, so a closed outline becomes a single POLYLINE or path.
+
+    with DXFWriter('switch.dxf') as dxf:
+        dxf.loop([(0, 0, 0), (10, 0, 0), (10, 10, 0), (0, 10, 0)])
+        dxf.circle(5, 5, 1.5)
+
+Meshes for the web viewer are written in one go with `write_mesh()`.
+"""
+import array
+import math
+import struct
+import sys
+
+PRECISION = 4  # Decimal places written for coordinates, in mm
+
+
+def _number(value):
+    """Format a coordinate without trailing zeros.
+    """
+    text = '%.*f' % (PRECISION, value)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+
+    return '0' if text == '-0' else text
+
+
+class Writer(object):
+    """Base class that handles opening, closing and counting the output.
+    """
+    mode = 'w'  # The mode files are opened with
+
+    def __init__(self, output):
+        if hasattr(output, 'write'):
+            self.file = output
+            self.close_file = False
+        else:
+            self.file = open(output, self.mode)
+            self.close_file = True
+        self.bytes = 0
+        self.entities = 0
+        self.closed = False
+        self.write(self.header())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        self.file.write(text)
+        self.bytes += len(text)
+
+    def header(self):
+        return ''
+
+    def footer(self):
+        return ''
+
+    def close(self):
+        """Finish the document and close the file if we opened it.
+        """
+        if self.closed:
+            return
+        self.write(self.footer())
+        self.closed = True
+        if self.close_file:
+            self.file.close()
+
+    def loop(self, vertices):
+        """Write a closed outline made of (x, y, bulge) vertices.
+        """
+        raise NotImplementedError
+
+    def line(self, x0, y0, x1, y1):
+        raise NotImplementedError
+
+    def arc(self, x, y, radius, start, end):
+        """Write a counter clockwise arc, angles are in degrees.
+        """
+        raise NotImplementedError
+
+    def circle(self, x, y, radius):
+        raise NotImplementedError
+
+
+class DXFWriter(Writer):
+    """Write LINE, ARC, CIRCLE and POLYLINE entities to an R12 DXF file.
+
+    R12 is the newest version that needs no handles, tables or subclass
+    markers, so a HEADER with $ACADVER and the ENTITIES section are a
+    complete file that strict readers (EG ezdxf) accept as well as FreeCAD,
+    LibreCAD and laser cutter software. Outlines are closed POLYLINEs with
+    a VERTEX for each point, arcs keep their bulge (group 42).
+    """
+    def header(self):
+        return '0\nSECTION\n2\nHEADER\n9\n$ACADVER\n1\nAC1009\n0\nENDSEC\n0\nSECTION\n2\nENTITIES\n'
+
+    def footer(self):
+        return '0\nENDSEC\n0\nEOF\n'
+
+    def loop(self, vertices):
+        out = ['0\nPOLYLINE\n8\n0\n66\n1\n10\n0\n20\n0\n30\n0\n70\n1\n']
+        for x, y, bulge in vertices:
+            out.append('0\nVERTEX\n8\n0\n10\n%s\n20\n%s\n30\n0\n' % (_number(x), _number(y)))
+            if bulge:
+                out.append('42\n%s\n' % repr(bulge))
+        out.append('0\nSEQEND\n8\n0\n')
+        self.write(''.join(out))
+        self.entities += 1
+
+    def line(self, x0, y0, x1, y1):
+        self.write('0\nLINE\n8\n0\n10\n%s\n20\n%s\n11\n%s\n21\n%s\n' % (_number(x0), _number(y0), _number(x1), _number(y1)))
+        self.entities += 1
+
+    def arc(self, x, y, radius, start, end):
+        self.write('0\nARC\n8\n0\n10\n%s\n20\n%s\n40\n%s\n50\n%s\n51\n%s\n' % (_number(x), _number(y), _number(radius), _number(start), _number(end)))
+        self.entities += 1
+
+    def circle(self, x, y, radius):
+        self.write('0\nCIRCLE\n8\n0\n10\n%s\n20\n%s\n40\n%s\n' % (_number(x), _number(y), _number(radius)))
+        self.entities += 1
+
+
+class SVGWriter(Writer):
+    """Write paths and circles to an SVG file.
+
+    SVG's Y axis points down, so Y is flipped to keep the drawing the same way
+    up as the DXF. The bounding box (min_x, min_y, max_x, max_y) is needed up
+    front for the viewBox.
+    """
+    def __init__(self, output, bbox):
+        self.bbox = bbox
+        super(SVGWriter, self).__init__(output)
+
+    def header(self):
+        min_x, min_y, max_x, max_y = self.bbox
+        width, height = max_x - min_x, max_y - min_y
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<svg xmlns="http://www.w3.org/2000/svg" width="%smm" height="%smm" viewBox="%s %s %s %s">\n'
+                '<g fill="none" stroke="black" stroke-width="0.1">\n') % (
+                    _number(width), _number(height), _number(min_x), _number(-max_y), _number(width), _number(height))
+
+    def footer(self):
+        return '</g>\n</svg>\n'
+
+    def loop(self, vertices):
+        out = ['<path d="M%s %s' % (_number(vertices[0][0]), _number(-vertices[0][1]))]
+        for i, (x0, y0, bulge) in enumerate(vertices):
+            x1, y1 = vertices[(i+1) % len(vertices)][:2]
+            if bulge:
+                chord = math.hypot(x1 - x0, y1 - y0)
+                radius = chord * (1 + bulge*bulge) / (4*abs(bulge))
+                large = 1 if abs(bulge) > 1 else 0
+                sweep = 0 if bulge > 0 else 1  # Flipping Y flips the direction too
+                out.append('A%s %s 0 %d %d %s %s' % (_number(radius), _number(radius), large, sweep, _number(x1), _number(-y1)))
+            elif i < len(vertices) - 1:
+                out.append('L%s %s' % (_number(x1), _number(-y1)))
+        out.append('Z"/>\n')
+        self.write(''.join(out))
+        self.entities += 1
+
+    def line(self, x0, y0, x1, y1):
+        self.write('<path d="M%s %sL%s %s"/>\n' % (_number(x0), _number(-y0), _number(x1), _number(-y1)))
+        self.entities += 1
+
+    def arc(self, x, y, radius, start, end):
+        start, end = math.radians(start), math.radians(end)
+        sweep_angle = (end - start) % (2*math.pi)
+        x0, y0 = x + radius*math.cos(start), y + radius*math.sin(start)
+        x1, y1 = x + radius*math.cos(end), y + radius*math.sin(end)
+        large = 1 if sweep_angle > math.pi else 0
+        self.write('<path d="M%s %sA%s %s 0 %d 0 %s %s"/>\n' % (
+            _number(x0), _number(-y0), _number(radius), _number(radius), large, _number(x1), _number(-y1)))
+        self.entities += 1
+
+    def circle(self, x, y, radius):
+        self.write('<circle cx="%s" cy="%s" r="%s"/>\n' % (_number(x), _number(-y), _number(radius)))
+        self.entities += 1
+
+
+class STLWriter(Writer):
+    """Write triangles to a binary STL file.
+
+    The triangle count in the header is filled in when the file is closed,
+    so the output has to be seekable.
+    """
+    mode = 'wb'
+    TRIANGLE = struct.Struct('<12fH')
+
+    def header(self):
+        return 'Binary STL exported by kb_builder'.ljust(80) + struct.pack('<I', 0)
+
+    def close(self):
+        if not self.closed:
+            self.file.seek(80)
+            self.file.write(struct.pack('<I', self.entities))
+            self.file.seek(0, 2)
+        super(STLWriter, self).close()
+
+    def triangle(self, a, b, c):
+        """Write a triangle made of three (x, y, z) points, counter clockwise seen from outside.
+        """
+        ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+        vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+        nx, ny, nz = uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx
+        length = math.sqrt(nx*nx + ny*ny + nz*nz) or 1
+        self.write(self.TRIANGLE.pack(nx/length, ny/length, nz/length, a[0], a[1], a[2], b[0], b[1], b[2], c[0], c[1], c[2], 0))
+        self.entities += 1
+
+
+def circle_of(vertices):
+    """Return (x, y, radius) when a loop is a full circle, otherwise None.
+
+    Circles are drawn as loops of two half circle edges.
+    """
+    if len(vertices) != 2 or abs(vertices[0][2]) != 1 or vertices[0][2] != vertices[1][2]:
+        return None
+    (x0, y0, bulge), (x1, y1, _) = vertices
+    center_x, center_y = (x0 + x1)/2, (y0 + y1)/2
+
+    return center_x, center_y, math.hypot(x1 - x0, y1 - y0)/2
+
+
+def write_outline(writer, loops):
+    """Write an iterable of (x, y, bulge) loops, full circles become CIRCLE entities.
+    """
+    for loop in loops:
+        circle = circle_of(loop)
+        if circle:
+            writer.circle(*circle)
+        else:
+            writer.loop(loop)
+
+    return writer
+
+
+def write_mesh(output, positions, normals, indices):
+    """Write an indexed triangle mesh for the web viewer, returns the bytes written.
+
+    The file is a 12 byte header ('KBM1', the vertex count and the index
+    count as little endian uint32s) followed by the positions and normals as
+    float32 x, y, z triples and the triangle indices as uint32s, all little
+    endian, so the viewer can load each block straight into a typed array.
+    """
+    blocks = [array.array('f', positions), array.array('f', normals), array.array('I', indices)]
+    if sys.byteorder == 'big':
+        for block in blocks:
+            block.byteswap()
+
+    with open(output, 'wb') as mesh_file:
+        mesh_file.write('KBM1' + struct.pack('<II', len(positions) // 3, len(indices)))
+        for block in blocks:
+            block.tofile(mesh_file)
+
+    return 12 + sum(block.itemsize * len(block) for block in blocks)
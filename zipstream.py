@@ -0,0 +1,104 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Write a ZIP archive of files on disk as a stream of chunks.
+
+Nothing is buffered beyond one chunk of one file, so an archive can be sent
+to the client while it is being made:
+
+    return Response(stream_zip([('switch.dxf', path, 6), ...]), content_type='application/zip')
+
+The CRC and sizes of each file are only known once it has been read, so they
+follow the file in a data descriptor and are repeated in the central
+directory at the end. Every entry is deflated, level 0 stores the data in
+uncompressed deflate blocks so readers never have to handle a stored entry
+with a data descriptor. ZIP64 isn't supported, archives have to stay under
+4GB and 65535 files.
+"""
+import os
+import struct
+import time
+import zlib
+
+CHUNK_SIZE = 64 * 1024  # Bytes read from a file at a time
+DEFAULT_LEVEL = 6  # zlib's default trade off between speed and size
+
+VERSION = 20  # The ZIP version needed to extract deflated entries
+FLAG_DATA_DESCRIPTOR = 0x08  # The CRC and sizes follow the data
+FLAG_UTF8 = 0x800  # The file name is UTF-8
+METHOD_DEFLATE = 8
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+
+
+def dos_time(timestamp):
+    """Return the (time, date) a ZIP header stores for a unix timestamp.
+    """
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01, the earliest date a ZIP can hold
+
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def stream_zip(files, chunk_size=CHUNK_SIZE):
+    """Yield a ZIP archive of files chunk by chunk.
+
+    `files` is a list of (name in the archive, path) or (name, path, deflate
+    level) tuples. Files are opened one at a time as the archive reaches them.
+    """
+    offset = 0
+    central = []
+    for entry in files:
+        name, path = entry[:2]
+        level = entry[2] if len(entry) > 2 and entry[2] is not None else DEFAULT_LEVEL
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        flags = FLAG_DATA_DESCRIPTOR | (FLAG_UTF8 if any(ord(c) > 127 for c in name) else 0)
+        mod_time, mod_date = dos_time(os.path.getmtime(path))
+
+        header = LOCAL_HEADER.pack(0x04034b50, VERSION, flags, METHOD_DEFLATE, mod_time, mod_date, 0, 0, 0, len(name), 0) + name
+        header_offset = offset
+        offset += len(header)
+        yield header
+
+        crc, size, compressed_size = 0, 0, 0
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        with open(path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(chunk_size), ''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                chunk = compressor.compress(chunk)
+                if chunk:
+                    compressed_size += len(chunk)
+                    yield chunk
+        chunk = compressor.flush()
+        compressed_size += len(chunk)
+        crc &= 0xffffffff
+
+        descriptor = DATA_DESCRIPTOR.pack(0x08074b50, crc, compressed_size, size)
+        offset += compressed_size + len(descriptor)
+        yield chunk + descriptor
+
+        if offset > 0xffffffff or len(central) >= 0xffff:
+            raise ValueError('Archives over 4GB or 65535 files need ZIP64')
+        central.append(CENTRAL_HEADER.pack(0x02014b50, VERSION, VERSION, flags, METHOD_DEFLATE, mod_time, mod_date,
+                                           crc, compressed_size, size, len(name), 0, 0, 0, 0, 0o644 << 16, header_offset) + name)
+
+    directory = ''.join(central)
+    yield directory + END_RECORD.pack(0x06054b50, 0, 0, len(central), len(central), len(directory), offset, 0)